@@ -0,0 +1,114 @@
+# coding: utf-8
+'''An asyncio engine for the Downloader (python 3.5+), used by
+`python downloader.py run --async`'''
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+from downloader import Downloader, Metrics
+
+
+class AsyncDownloader(Downloader):
+    '''A Downloader running the search of each series (gather_serie), the
+    torrent file download and the magnet push as coroutines. Every series
+    goes through its own pipeline, so a found torrent reaches the action
+    without waiting for the slowest series. Requests to the same host,
+    every mirror included, are limited to settings.host_connections at a
+    time and magnets are pushed one batch at a time.
+
+    The network calls still go through the pooled requests sessions, each
+    one awaited on a thread pool so the event loop is never blocked.'''
+
+    def run(self):
+        '''Runs the action defined on the settings file'''
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self.run_async())
+        finally:
+            loop.close()
+
+    async def run_async(self):
+        self.metrics = Metrics()
+        self.start_push()
+        self.rewound = {}
+        self.host_limits = {}
+        self.search_slots = {}
+        self.search_slots_lock = threading.Lock()
+        self.push_limit = asyncio.Semaphore(1)
+        # settings.workers searches, or enough to keep every mirror busy,
+        # plus room for the torrent downloads and the pushes
+        searches = max(self.workers, self.host_connections * len(self.mirrors))
+        self.search_limit = asyncio.Semaphore(searches)
+        self.executor = ThreadPoolExecutor(
+            max_workers=searches + self.host_connections * 2)
+        try:
+            self.folder = self.download_folder or ''
+            if self.action == 'download_torrent_files' and self.folder:
+                if not os.path.isdir(self.folder):
+                    os.makedirs(self.folder)
+            if self.action == 'download_from_magnets':
+                async with self.push_limit:
+                    await self.call(
+                        self.download_url, self.push_queued_magnets)
+            results = await asyncio.gather(
+                *[self.process(serie) for serie in self.due_series()])
+            await self.push(self.take_pending_magnets())
+        finally:
+            self.executor.shutdown()
+            self.finish_gather()
+        torrent_list = [
+            torrent for torrents in results for torrent in torrents]
+        if self.action == 'show_magnets':
+            return '\n'.join(
+                [torrent['magnet_link'] for torrent in torrent_list])
+
+    async def call(self, url, func, *args, **kwargs):
+        '''Await func on the thread pool, limited per host of url'''
+        host = urlparse(url).netloc
+        if host not in self.host_limits:
+            self.host_limits[host] = asyncio.Semaphore(self.host_connections)
+        async with self.host_limits[host]:
+            return await asyncio.get_event_loop().run_in_executor(
+                self.executor, partial(func, *args, **kwargs))
+
+    def request_search(self, url, key):
+        '''Wait for a free connection to the host of the mirror searched,
+        race_mirrors reaches every mirror from its own threads'''
+        host = urlparse(url).netloc
+        with self.search_slots_lock:
+            if host not in self.search_slots:
+                self.search_slots[host] = threading.BoundedSemaphore(
+                    self.host_connections)
+        with self.search_slots[host]:
+            return super(AsyncDownloader, self).request_search(url, key)
+
+    async def push(self, magnets):
+        '''Push the magnets, one batch at a time so the pushes never race
+        on the pending and deferred magnets'''
+        if magnets:
+            async with self.push_limit:
+                await self.call(self.download_url, self.push_magnets, magnets)
+
+    async def process(self, serie):
+        '''Search a series and run the action on what was found'''
+        async with self.search_limit:
+            torrents = await asyncio.get_event_loop().run_in_executor(
+                self.executor, self.gather_serie, serie)
+        for torrent in torrents:
+            if self.action == 'download_from_magnets':
+                if 'magnet' in torrent['magnet_link']:
+                    await self.push(self.queue_magnet(torrent['magnet_link']))
+            elif self.action == 'download_torrent_files':
+                try:
+                    await self.call(torrent['torrent_url'],
+                                    self.download_torrent_file, torrent,
+                                    self.folder)
+                except (IOError, OSError) as error:
+                    self.torrent_failed(torrent, error)
+        return torrents
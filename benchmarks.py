@@ -0,0 +1,399 @@
+# coding: utf-8
+'''Benchmarks for the downloader running against a local fake index.
+
+Run with `python benchmarks.py <benchmark> [options]`, see --help.'''
+import argparse
+import glob
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from bs4 import FeatureNotFound
+
+import downloader as sad
+from fake_index import FakeIndex
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FIXTURES = os.path.join(HERE, 'fixtures')
+BASELINE = os.path.join(HERE, 'benchmarks_baseline.json')
+ACTIONS = ['show_magnets', 'download_torrent_files', 'download_from_magnets']
+
+
+@contextmanager
+def workspace(settings, watchlist):
+    '''Run inside a temporary folder holding the given settings and
+    watchlist files'''
+    old_dir = os.getcwd()
+    folder = tempfile.mkdtemp(prefix='sad-bench-')
+    try:
+        os.chdir(folder)
+        write_json('settings.json', settings)
+        write_json('watchlist.json', watchlist)
+        yield folder
+    finally:
+        os.chdir(old_dir)
+        shutil.rmtree(folder)
+
+
+def write_json(filename, content):
+    with open(filename, 'w') as json_file:
+        json.dump(content, json_file)
+
+
+def bench_settings(index, **kwargs):
+    settings = sad.Settings.default_settings()
+    # Measure the downloader, not the politeness towards the index
+    settings.update(search_engine=index.search_engine, search_rate='0',
+                    **kwargs)
+    return settings
+
+
+def synthetic_watchlist(size, quality='SD', episode='S01E00'):
+    return dict(('Serie.{0}'.format(n), {
+        'download': True,
+        'quality': quality,
+        'latest-downloaded-episode': episode}) for n in range(size))
+
+
+def bench_gather(args):
+    '''Wall-clock time of gather_torrent_list by number of workers'''
+    print('series={0} delay={1}s'.format(args.series, args.delay))
+    print('{0:>8} {1:>10} {2:>10} {3:>9} {4:>12}'.format(
+        'workers', 'seconds', 'series/s', 'speedup', 'conns/reqs'))
+    baseline = None
+    with FakeIndex(delay=args.delay) as index:
+        for workers in args.workers or [1, 2, 4, 8, 16]:
+            settings = bench_settings(index, workers=str(workers))
+            watchlist = synthetic_watchlist(args.series)
+            with workspace(settings, watchlist):
+                downloader = sad.Downloader()
+                start = time.time()
+                found = downloader.gather_torrent_list()
+                elapsed = time.time() - start
+                stats = downloader.connection_stats()['search_engine']
+                downloader.close()
+            assert len(found) == args.series
+            baseline = baseline or elapsed
+            print('{0:>8} {1:>10.3f} {2:>10.1f} {3:>8.1f}x {4:>12}'.format(
+                workers, elapsed, args.series / elapsed, baseline / elapsed,
+                '{connections}/{requests}'.format(**stats)))
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+
+def run_once(index, action, size, workers, trace=False):
+    '''Downloader.run over a synthetic watchlist, returning its throughput
+    and per series latency percentiles, or only its peak traced memory when
+    trace is set, since tracemalloc slows the run several times over'''
+    remote_settings = {'download_url': index.download_url,
+                       'username': index.username,
+                       'password': index.password}
+    settings = bench_settings(index, action=action, workers=str(workers),
+                              download_folder='downloads',
+                              remote_settings=remote_settings)
+    with workspace(settings, synthetic_watchlist(size)):
+        if trace:
+            tracemalloc.start()
+        try:
+            downloader = sad.Downloader()
+            start = time.time()
+            downloader.run()
+            elapsed = time.time() - start
+            if trace:
+                return {'peak MB': tracemalloc.get_traced_memory()[1] /
+                        1024.0 / 1024}
+        finally:
+            if trace:
+                tracemalloc.stop()
+            downloader.close()
+        with open('watchlist.json') as watchlist:
+            found = [serie for serie in json.load(watchlist).values()
+                     if serie['latest-downloaded-episode'] == 'S01E01']
+    assert len(found) == size, '{0} of {1} found'.format(len(found), size)
+    latencies = list(downloader.metrics.series.values())
+    return {'series/s': size / elapsed,
+            'p50 ms': percentile(latencies, 50) * 1000,
+            'p95 ms': percentile(latencies, 95) * 1000,
+            'p99 ms': percentile(latencies, 99) * 1000}
+
+
+def regressions(result, baseline, tolerance):
+    '''The measures of result worse than baseline by more than tolerance'''
+    worse = []
+    if result['series/s'] < baseline['series/s'] * (1 - tolerance):
+        worse.append('series/s')
+    for measure in ('p95 ms', 'peak MB'):
+        if result[measure] > baseline[measure] * (1 + tolerance):
+            worse.append(measure)
+    return worse
+
+
+def bench_run(args):
+    '''Downloader.run for each action over 10 to 10,000 series, compared
+    against the stored baseline, with the last of --workers or 16 workers.
+    Returns 1 when any of them regressed, 2 when there is no baseline to
+    compare to and --save-baseline was not given'''
+    sizes = args.sizes or [10, 100, 1000, 10000]
+    workers = args.workers[-1] if args.workers else 16
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    elif not args.save_baseline:
+        print('no baseline at {0}, record one on this machine with '
+              '--save-baseline'.format(args.baseline))
+        return 2
+    measures = ['series/s', 'p50 ms', 'p95 ms', 'p99 ms', 'peak MB']
+    print('delay={0}s workers={1} tolerance={2:.0%}'.format(
+        args.delay, workers, args.tolerance))
+    print('{0:>24} {1:>7} '.format('action', 'series') +
+          ' '.join('{0:>9}'.format(measure) for measure in measures) +
+          '  baseline')
+    results = {}
+    failed = False
+    with FakeIndex(delay=args.delay) as index:
+        for action in ACTIONS:
+            for size in sizes:
+                key = '{0}/{1}'.format(action, size)
+                result = results[key] = run_once(
+                    index, action, size, workers)
+                result.update(run_once(
+                    index, action, size, workers, trace=True))
+                if key not in baseline:
+                    verdict = 'none'
+                else:
+                    worse = regressions(result, baseline[key], args.tolerance)
+                    failed = failed or bool(worse)
+                    verdict = 'REGRESSED ' + ', '.join(worse) if worse else 'ok'
+                print('{0:>24} {1:>7} '.format(action, size) +
+                      ' '.join('{0:>9.1f}'.format(result[measure])
+                               for measure in measures) +
+                      '  ' + verdict)
+    if args.save_baseline:
+        baseline.update(results)
+        write_json(args.baseline, baseline)
+        print('baseline saved to ' + args.baseline)
+    return 1 if failed else 0
+
+
+def bench_seed(args):
+    '''Time to seed a watchlist from a series list, and to record an
+    episode for every series'''
+    print('{0:>8} {1:>10} {2:>10} {3:>10}'.format(
+        'series', 'seed s', 'update s', 'flush s'))
+    for size in args.sizes or [100, 1000, 10000]:
+        names = ['Serie {0}'.format(n) for n in range(size)]
+        with workspace(sad.Settings.default_settings(), {}):
+            start = time.time()
+            watchlist = sad.Watchlist(series_list=names)
+            seeded = time.time()
+            for name in watchlist.watchlist:
+                watchlist.update_watchlist(name, 'S01E01')
+            updated = time.time()
+            watchlist.flush()
+            flushed = time.time()
+            assert len(watchlist.load_watchlist()) == size
+        print('{0:>8} {1:>10.3f} {2:>10.3f} {3:>10.3f}'.format(
+            size, seeded - start, updated - seeded, flushed - updated))
+
+
+def fixture_pages():
+    '''Saved result pages as (name, episode, content), the query is taken
+    from the file name'''
+    pages = []
+    for filename in sorted(glob.glob(os.path.join(FIXTURES, '*.html'))):
+        query = os.path.basename(filename)[:-len('.html')]
+        name, episode = query.rsplit('.', 1)
+        with open(filename, 'rb') as page:
+            pages.append((name, episode, page.read()))
+    return pages
+
+
+def available_parsers():
+    parsers = []
+    for parser in ['html.parser'] + sorted(set(sad.PARSERS) - {'html.parser'}):
+        try:
+            sad.make_soup('', parser)
+            parsers.append(parser)
+        except FeatureNotFound:
+            print('{0}: not installed, skipped'.format(parser))
+    return parsers
+
+
+def bench_parse(args):
+    '''Pages per second parsed by each parser backend over the fixtures,
+    checking they all return the same download options'''
+    pages = fixture_pages()
+    print('pages={0} rounds={1}'.format(len(pages), args.rounds))
+    print('{0:>14} {1:>10} {2:>9}'.format('parser', 'pages/s', 'speedup'))
+    reference = baseline = None
+    with workspace(sad.Settings.default_settings(), {}):
+        downloader = sad.Downloader()
+        for parser in available_parsers():
+            start = time.time()
+            for _ in range(args.rounds):
+                options = [downloader.fetch_download_table(
+                    sad.make_soup(content, parser), name, episode, limit=1000)
+                    for name, episode, content in pages]
+            elapsed = time.time() - start
+            reference = reference or options
+            assert options == reference, parser + ' parsed different options'
+            rate = len(pages) * args.rounds / elapsed
+            baseline = baseline or rate
+            print('{0:>14} {1:>10.1f} {2:>8.1f}x'.format(
+                parser, rate, rate / baseline))
+
+
+def first_exact_match(options, quality):
+    '''How select_download picked a release before ranking them'''
+    for option in options:
+        if option['quality'] == quality:
+            return option
+
+
+def bench_rank(args):
+    '''Selections per second of the release ranking over the whole tables of
+    the fixtures, against the first exact quality match, with the relative
+    expected download time (size over seeds) of what each one picks'''
+    pages = fixture_pages()
+    profiles = [
+        ('SD', sad.Preferences('SD')),
+        ('1080p,720p,SD', sad.Preferences('1080p,720p,SD')),
+        ('720p,SD seeds>=200', sad.Preferences('720p,SD', min_seeds=200)),
+        ('1080p,720p <1GB', sad.Preferences('1080p,720p', max_size=1000)),
+    ]
+    print('pages={0} rounds={1}'.format(len(pages), args.rounds))
+    print('{0:>20} {1:>12} {2:>12} {3:>10} {4:>10}'.format(
+        'preferences', 'exact sel/s', 'ranked sel/s', 'exact time',
+        'ranked time'))
+    with workspace(sad.Settings.default_settings(), {}):
+        downloader = sad.Downloader()
+        tables = [downloader.fetch_download_table(
+            sad.make_soup(content), name, episode)
+            for name, episode, content in pages]
+        for label, preferences in profiles:
+            start = time.time()
+            for _ in range(args.rounds):
+                exact = [first_exact_match(options, preferences.qualities[0])
+                         for options in tables]
+            exact_rate = len(tables) * args.rounds / (time.time() - start)
+            start = time.time()
+            for _ in range(args.rounds):
+                ranked = [(preferences.rank(options) or [None])[0]
+                          for options in tables]
+            ranked_rate = len(tables) * args.rounds / (time.time() - start)
+
+            def total_time(picks):
+                picks = [pick for pick in picks if pick]
+                return '{0:.1f}/{1}'.format(sum(
+                    preferences.expected_time(pick) for pick in picks),
+                    len(picks))
+            print('{0:>20} {1:>12.0f} {2:>12.0f} {3:>10} {4:>10}'.format(
+                label, exact_rate, ranked_rate, total_time(exact),
+                total_time(ranked)))
+
+
+# Commands that never go online, and what they must not import
+FAST_COMMANDS = [[], ['-a', 'show_magnets'], ['-df', 'downloads'],
+                 ['-sl', 'Serie 1,Serie 2']]
+HEAVY_MODULES = ['requests', 'bs4', 'urllib3', 'concurrent.futures',
+                 'async_downloader', 'remote']
+
+
+def import_times(args):
+    '''Run python -X importtime with args and return the cumulative
+    microseconds of the modules it imported, by name, and their total'''
+    env = dict(os.environ, PYTHONPATH=HERE)
+    output = subprocess.Popen(
+        [sys.executable, '-X', 'importtime'] + args, env=env,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True).communicate()[1]
+    times, total = {}, 0
+    for line in output.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line.split('|')
+        if not cumulative.strip().isdigit():
+            continue
+        times[name.strip()] = int(cumulative)
+        # Nested imports are indented, their time is in their parent's
+        if not name[1:].startswith(' '):
+            total += int(cumulative)
+    return times, total
+
+
+def bench_startup(args):
+    '''Startup time of the commands that stay offline, which must not import
+    the network and parsing modules. Returns 1 when one of them does'''
+    script = os.path.join(HERE, 'downloader.py')
+    print('rounds={0}'.format(args.rounds))
+    print('{0:>34} {1:>9} {2:>10}  {3}'.format(
+        'command', 'wall ms', 'import ms', 'heavy imports'))
+    failed = False
+    runs = [('python -c pass', ['-c', 'pass'], False),
+            ('what run imports', ['-c', 'import downloader, remote, bs4'],
+             False)]
+    runs += [(' '.join(['downloader.py'] + command), [script] + command, True)
+             for command in FAST_COMMANDS]
+    with workspace(sad.Settings.default_settings(), {}):
+        for label, command, fast in runs:
+            start = time.time()
+            for _ in range(args.rounds):
+                times, total = import_times(command)
+            wall = (time.time() - start) / args.rounds * 1000
+            heavy = [name for name in HEAVY_MODULES if name in times]
+            if fast:
+                failed = failed or bool(heavy)
+            print('{0:>34} {1:>9.1f} {2:>10.1f}  {3}'.format(
+                label, wall, total / 1000.0,
+                ', '.join(heavy) if fast and heavy else ''))
+    return 1 if failed else 0
+
+
+BENCHMARKS = {
+    'gather': bench_gather,
+    'parse': bench_parse,
+    'rank': bench_rank,
+    'run': bench_run,
+    'seed': bench_seed,
+    'startup': bench_startup,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--series', type=int, default=100)
+    parser.add_argument('--delay', type=float, default=0.02,
+                        help='seconds the fake index sleeps per request')
+    parser.add_argument('--workers', type=int, nargs='+',
+                        help='worker counts of the gather benchmark, '
+                             '1 to 16 by default; the run benchmark uses '
+                             'the last one, 16 by default')
+    parser.add_argument('--rounds', type=int, default=50)
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        help='watchlist sizes of the run and seed benchmarks')
+    parser.add_argument('--baseline', default=BASELINE,
+                        help='results the run benchmark is compared to')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='store the run results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='fraction a run result may be worse than the '
+                             'baseline before it counts as a regression')
+    args = parser.parse_args()
+    sys.exit(BENCHMARKS[args.benchmark](args))
+
+
+if __name__ == '__main__':
+    main()
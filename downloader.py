@@ -1,12 +1,548 @@
 # coding: utf-8
 import sys
-import requests
 import re
+import argparse
 import os
 import json
-from bs4 import BeautifulSoup
-from requests.auth import HTTPDigestAuth
-from datetime import datetime
+import hashlib
+import math
+import random
+import signal
+import socket
+import tempfile
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import date, datetime
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+
+QUALITY_PATTERN = re.compile(r'(\d{3,4}p)')
+
+# Bytes written at a time when streaming torrent files to disk
+CHUNK_SIZE = 16 * 1024
+
+# Parser backends for the search result pages: the bs4 tree builder and
+# whether only the <table> elements are built
+PARSERS = {
+    'html.parser': ('html.parser', False),
+    'strainer': ('html.parser', True),
+    'lxml': ('lxml', False),
+    'lxml-strainer': ('lxml', True),
+}
+
+
+def make_soup(content, parser='strainer'):
+    '''Parse a search result page with one of the PARSERS backends'''
+    # Imported here, like requests, to keep the offline commands fast
+    from bs4 import BeautifulSoup, SoupStrainer
+    builder, strained = PARSERS[parser]
+    return BeautifulSoup(content, builder,
+                         parse_only=SoupStrainer('table') if strained else None)
+
+
+class TransientError(Exception):
+    '''The search engine answered 429 or 5xx, worth trying again later'''
+
+    def __init__(self, response):
+        super(TransientError, self).__init__(
+            '{0} {1}'.format(response.status_code, response.reason))
+        self.retry_after = parse_retry_after(
+            response.headers.get('Retry-After'))
+
+
+def transient_errors():
+    '''The failures retried by the RetryScheduler, an empty result is not
+    one of them. A function so requests is only imported once needed'''
+    import requests
+    return (TransientError, requests.ConnectionError, requests.Timeout)
+
+
+def parse_retry_after(value):
+    '''Seconds to wait from a Retry-After header, in seconds or date form'''
+    if not value:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        from email.utils import mktime_tz, parsedate_tz
+        date = parsedate_tz(value)
+        if date:
+            return max(0, mktime_tz(date) - time.time())
+
+
+class RetryScheduler(object):
+    '''Calls a function retrying transient_errors() up to `retries` attempts,
+    waiting an exponential backoff with full jitter between them, or what
+    the server asked for with Retry-After'''
+
+    def __init__(self, retries=3, backoff=1, max_backoff=60,
+                 sleep=time.sleep):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.sleep = sleep
+
+    def call(self, func, *args, **kwargs):
+        attempt = 1
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except transient_errors() as error:
+                if attempt >= self.retries:
+                    raise
+                self.sleep(self.delay(attempt, error))
+                attempt += 1
+
+    def delay(self, attempt, error):
+        retry_after = getattr(error, 'retry_after', None)
+        if retry_after is not None:
+            return min(retry_after, self.max_backoff)
+        return random.uniform(
+            0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+
+
+class RateLimiter(object):
+    '''A token bucket per host allowing bursts of `burst` requests and
+    `rate` requests per second after that. A rate of 0 means no limit'''
+
+    def __init__(self, rate=5, burst=5):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, host):
+        '''Block until a request to host is allowed'''
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = time.time()
+                tokens, updated = self.buckets.get(host, (self.burst, now))
+                tokens = min(self.burst, tokens + (now - updated) * self.rate)
+                if tokens >= 1:
+                    self.buckets[host] = (tokens - 1, now)
+                    return
+                self.buckets[host] = (tokens, now)
+                wait = (1 - tokens) / self.rate
+            time.sleep(wait)
+
+
+class Mirrors(object):
+    '''The search engine mirrors, ranked by how well they have answered:
+    an average of their latency plus a penalty for their error rate.
+    Mirrors never tried come first'''
+    error_penalty = 10.0
+    smoothing = 0.3
+
+    def __init__(self, engines, filename='mirrors.json'):
+        if not isinstance(engines, list):
+            engines = [engines]
+        self.engines = engines
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.stats = dict((engine, {'requests': 0, 'errors': 0,
+                                    'latency': None}) for engine in engines)
+        if len(engines) > 1:
+            self.load()
+
+    def __len__(self):
+        return len(self.engines)
+
+    def load(self):
+        try:
+            with open(self.filename) as mirrors_file:
+                stats = json.load(mirrors_file)
+        except (IOError, ValueError):
+            return
+        for engine in self.engines:
+            self.stats[engine].update(stats.get(engine, {}))
+
+    def save(self):
+        if len(self.engines) > 1:
+            with self.lock:
+                content = json.dumps(self.stats)
+            atomic_write(self.filename, content)
+
+    def record(self, engine, latency=None):
+        '''Record an answer from engine, or an error when no latency'''
+        with self.lock:
+            stats = self.stats[engine]
+            stats['requests'] += 1
+            if latency is None:
+                stats['errors'] += 1
+            elif stats['latency'] is None:
+                stats['latency'] = latency
+            else:
+                stats['latency'] += self.smoothing * (
+                    latency - stats['latency'])
+
+    def score(self, engine):
+        stats = self.stats[engine]
+        if not stats['requests']:
+            return -1
+        error_rate = float(stats['errors']) / stats['requests']
+        return (stats['latency'] or 0) + error_rate * self.error_penalty
+
+    def ranked(self):
+        with self.lock:
+            return sorted(self.engines, key=self.score)
+
+
+class Metrics(object):
+    '''Counts, bytes and latency histograms of the hot paths of a run, per
+    phase (search, parse, select, torrent, push) and per host, plus the
+    time spent on each series'''
+    # Upper bounds, in seconds, of the latency histogram buckets
+    buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+               10, 30)
+
+    def __init__(self):
+        self.started = time.time()
+        self.phases = {}
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def new_stats(self):
+        return {'count': 0, 'errors': 0, 'bytes': 0, 'seconds': 0.0,
+                'max': 0.0, 'histogram': [0] * (len(self.buckets) + 1)}
+
+    def add(self, stats, seconds, size, error):
+        stats['count'] += 1
+        stats['errors'] += int(error)
+        stats['bytes'] += size
+        stats['seconds'] += seconds
+        stats['max'] = max(stats['max'], seconds)
+        bucket = len(self.buckets)
+        for index, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                bucket = index
+                break
+        stats['histogram'][bucket] += 1
+
+    def record(self, phase, seconds, host=None, size=0, error=False):
+        with self.lock:
+            if phase not in self.phases:
+                self.phases[phase] = dict(self.new_stats(), hosts={})
+            stats = self.phases[phase]
+            self.add(stats, seconds, size, error)
+            if host:
+                if host not in stats['hosts']:
+                    stats['hosts'][host] = self.new_stats()
+                self.add(stats['hosts'][host], seconds, size, error)
+
+    @contextmanager
+    def timer(self, phase, host=None):
+        '''Time the block as a phase, it may set sample['bytes']'''
+        sample = {'bytes': 0}
+        start = time.time()
+        error = False
+        try:
+            yield sample
+        except:
+            error = True
+            raise
+        finally:
+            self.record(phase, time.time() - start, host, sample['bytes'],
+                        error)
+
+    def record_serie(self, name, seconds):
+        with self.lock:
+            self.series[name] = self.series.get(name, 0) + seconds
+
+    def report(self, slowest=10):
+        with self.lock:
+            series = sorted(self.series.items(), key=lambda item: -item[1])
+            return {
+                'started': datetime.fromtimestamp(
+                    self.started).isoformat(),
+                'seconds': time.time() - self.started,
+                'histogram_buckets': list(self.buckets) + ['inf'],
+                'phases': json.loads(json.dumps(self.phases)),
+                'slowest_series': [{'name': name, 'seconds': seconds}
+                                   for name, seconds in series[:slowest]]}
+
+
+class SearchCache(object):
+    '''An on-disk cache of parsed search results keyed by the query url.
+    Entries younger than ttl seconds are served without touching the
+    network, older ones are revalidated with their ETag/Last-Modified.
+    Only the `size` most recently used entries are kept'''
+
+    def __init__(self, filename='search_cache.json', ttl=3600, size=5000,
+                 enabled=True):
+        self.filename = filename
+        self.ttl = ttl
+        self.size = size
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'revalidated': 0, 'misses': 0}
+        self.entries = self.load() if enabled else OrderedDict()
+
+    def load(self):
+        try:
+            with open(self.filename) as cache_file:
+                return json.load(cache_file, object_pairs_hook=OrderedDict)
+        except (IOError, ValueError):
+            return OrderedDict()
+
+    def save(self):
+        if not self.enabled:
+            return
+        with self.lock:
+            content = json.dumps(self.entries)
+        atomic_write(self.filename, content)
+
+    def touch(self, url):
+        '''Mark url as the most recently used entry'''
+        entry = self.entries.pop(url)
+        self.entries[url] = entry
+        return entry
+
+    def lookup(self, url):
+        '''Return the cached rows for url if still fresh, otherwise None'''
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry and time.time() - entry['fetched'] < self.ttl:
+                self.stats['hits'] += 1
+                return self.touch(url)['rows']
+
+    def conditional_headers(self, url):
+        headers = {}
+        entry = self.entries.get(url)
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def revalidate(self, url):
+        '''The server answered 304, refresh and return the cached rows'''
+        with self.lock:
+            self.stats['revalidated'] += 1
+            entry = self.touch(url)
+            entry['fetched'] = time.time()
+            return entry['rows']
+
+    def store(self, url, rows, response):
+        with self.lock:
+            self.stats['misses'] += 1
+            if not self.enabled:
+                return
+            self.entries.pop(url, None)
+            self.entries[url] = {
+                'rows': rows,
+                'fetched': time.time(),
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified')}
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def merge(self, entries):
+        '''Keep the most recently fetched of our entries and the given ones'''
+        with self.lock:
+            for url, entry in entries.items():
+                ours = self.entries.get(url)
+                if ours is None or ours['fetched'] < entry['fetched']:
+                    self.entries.pop(url, None)
+                    self.entries[url] = entry
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def report(self):
+        return 'search cache: {hits} hits, {revalidated} revalidated, ' \
+            '{misses} misses'.format(**self.stats)
+
+
+# Statuses of a torrent client refusing the magnets themselves, any other
+# failure is the client's and the magnets are pushed again later
+PUSH_REJECTED = (400, 415)
+
+INFO_HASH = re.compile(r'urn:btih:([0-9a-zA-Z]+)')
+
+
+def info_hash(magnet_link):
+    '''The upper cased info-hash of a magnet link, or the link itself'''
+    found = INFO_HASH.search(magnet_link)
+    return found.group(1).upper() if found else magnet_link
+
+
+class TorrentIndex(object):
+    '''The info-hashes of every torrent downloaded or pushed, kept in a
+    SQLite database so no torrent is fetched twice across runs. A Bloom
+    filter sized for `capacity` hashes answers most lookups from memory,
+    only its hits are checked against the database. Past capacity the
+    filter just gives more false hits, memory stays the same'''
+    schema = [
+        '''CREATE TABLE IF NOT EXISTS torrents (
+            info_hash TEXT PRIMARY KEY,
+            name TEXT,
+            added REAL)''',
+        '''CREATE TABLE IF NOT EXISTS bloom (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            bits INTEGER NOT NULL,
+            hashes INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            filter BLOB NOT NULL)''',
+    ]
+
+    def __init__(self, filename='torrents.db', capacity=1000000,
+                 error_rate=0.01):
+        import sqlite3
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        with self.connection:
+            for statement in self.schema:
+                self.connection.execute(statement)
+        ln2 = math.log(2)
+        self.bits = int(-capacity * math.log(error_rate) / ln2 ** 2) or 8
+        self.hashes = max(1, int(round(self.bits / float(capacity) * ln2)))
+        self.load()
+
+    def load(self):
+        '''Load the saved filter, rebuilt from the database if it was not
+        saved after the last additions, from this or another process'''
+        self.count = self.connection.execute(
+            'SELECT COUNT(*) FROM torrents').fetchone()[0]
+        saved = self.connection.execute(
+            'SELECT bits, hashes, count, filter FROM bloom').fetchone()
+        if saved and saved[:3] == (self.bits, self.hashes, self.count):
+            self.filter = bytearray(saved[3])
+            return
+        self.filter = bytearray((self.bits + 7) // 8)
+        for row in self.connection.execute('SELECT info_hash FROM torrents'):
+            self.set_bits(row[0])
+
+    def save(self):
+        '''Save the filter with the number of hashes it holds'''
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO bloom VALUES (1, ?, ?, ?, ?)',
+                (self.bits, self.hashes, self.count, bytes(self.filter)))
+
+    def positions(self, info_hash):
+        '''The filter bits of an info-hash, by double hashing'''
+        digest = hashlib.sha1(info_hash.encode('utf-8')).hexdigest()
+        first, second = int(digest[:16], 16), int(digest[16:32], 16) | 1
+        return [(first + n * second) % self.bits for n in range(self.hashes)]
+
+    def set_bits(self, info_hash):
+        for position in self.positions(info_hash):
+            self.filter[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, magnet_link):
+        key = info_hash(magnet_link)
+        for position in self.positions(key):
+            if not self.filter[position >> 3] & (1 << (position & 7)):
+                return False
+        with self.lock:
+            return self.connection.execute(
+                'SELECT 1 FROM torrents WHERE info_hash = ?',
+                (key,)).fetchone() is not None
+
+    def add(self, magnet_links, name=None):
+        keys = [info_hash(magnet_link) for magnet_link in magnet_links]
+        with self.lock, self.connection:
+            cursor = self.connection.executemany(
+                'INSERT OR IGNORE INTO torrents VALUES (?, ?, ?)',
+                [(key, name, time.time()) for key in keys])
+            self.count += cursor.rowcount
+            for key in keys:
+                self.set_bits(key)
+
+    def close(self):
+        self.connection.close()
+
+
+def atomic_write(filename, content):
+    '''Write content to a temporary file and rename it over filename, so
+    a crash never leaves a half written file behind'''
+    folder = os.path.dirname(os.path.abspath(filename))
+    handle, temp_name = tempfile.mkstemp(dir=folder, suffix='.tmp')
+    try:
+        with os.fdopen(handle, 'w') as temp_file:
+            temp_file.write(content)
+        # os.replace also overwrites on windows, python 2 only has rename
+        getattr(os, 'replace', os.rename)(temp_name, filename)
+    except:
+        os.remove(temp_name)
+        raise
+
+
+SIZE_PATTERN = re.compile(r'([\d.,]+)\s*([KMGT])i?B', re.IGNORECASE)
+
+# Megabytes in each unit of the size cell
+SIZE_UNITS = {'K': 1 / 1024.0, 'M': 1, 'G': 1024, 'T': 1024 * 1024}
+
+
+def megabytes(text):
+    '''The size of a size cell like "1.37 GB" in MB, as a string like the
+    other cells, or the text itself if it holds no size'''
+    found = SIZE_PATTERN.search(text)
+    if not found:
+        return text.strip()
+    size = number(found.group(1))
+    if size is None:
+        return text.strip()
+    return '{0:.2f}'.format(size * SIZE_UNITS[found.group(2).upper()])
+
+
+def number(text):
+    '''A number out of a size or seeds cell, None if there is none'''
+    try:
+        return float(text.replace(',', ''))
+    except (AttributeError, ValueError):
+        return None
+
+
+class Preferences(object):
+    '''How the download of an episode is picked among its releases.
+    Releases of a quality not in `qualities`, with less than min_seeds seeds
+    or a size (in MB) out of min_size and max_size (0 for no bound) are left
+    out. The rest are ranked by the order of their quality in `qualities`,
+    then by their expected download time'''
+    # More seeds than this rarely make a single download any faster
+    saturation = 50
+
+    def __init__(self, qualities='SD', min_seeds=0, min_size=0, max_size=0):
+        if not isinstance(qualities, list):
+            qualities = [quality.strip() for quality in qualities.split(',')]
+        self.qualities = qualities
+        self.min_seeds = min_seeds
+        self.min_size = min_size
+        self.max_size = max_size
+
+    def allowed(self, option):
+        if option['quality'] not in self.qualities:
+            return False
+        seeds, size = number(option['seeds']), number(option['size'])
+        if self.min_seeds and (seeds is None or seeds < self.min_seeds):
+            return False
+        if self.min_size and (size is None or size < self.min_size):
+            return False
+        if self.max_size and (size is None or size > self.max_size):
+            return False
+        return True
+
+    def expected_time(self, option):
+        '''Size over seeds, a relative download time rather than seconds'''
+        seeds, size = number(option['seeds']), number(option['size'])
+        if not seeds or size is None:
+            return float('inf')
+        return size / min(seeds, self.saturation)
+
+    def rank(self, options):
+        '''The allowed options, the one to download first'''
+        return sorted(
+            [option for option in options if self.allowed(option)],
+            key=lambda option: (self.qualities.index(option['quality']),
+                                self.expected_time(option)))
 
 
 class Downloader(object):
@@ -14,82 +550,499 @@ class Downloader(object):
     tv series and run the action on Settings'''
 
     def __init__(self, **kwargs):
-        self.series = Watchlist()
-        self.download_list = self.series.load_downloadable_watchlist()
+        from requests.auth import HTTPDigestAuth
         settings = Settings()
+        self.series = open_watchlist(settings)
+        self.download_list = self.series.load_downloadable_watchlist()
+        self.shard = kwargs.get('shard')
+        if self.shard:
+            shard, shards = self.shard
+            self.download_list = [
+                serie for serie in self.download_list
+                if shard_of(serie['name'], shards) == shard]
+            self.series = WatchlistChanges(self.series, self.download_list)
         self.download_url = settings.remote_settings['download_url']
         self.username = settings.remote_settings['username']
         self.password = settings.remote_settings['password']
-        self.search_engine = settings.search_engine
+        self.mirrors = Mirrors(settings.search_engine)
+        self.search_engine = self.mirrors.engines[0]
+        self.hedge = int(settings.mirror_hedge)
         self.retries = int(settings.retries)
+        self.workers = int(settings.workers)
+        self.host_connections = int(settings.host_connections)
         self.action = settings.action
-        self.ep_pattern = re.compile('([sS]\d{2}[eE]\d{2})')
+        self.ep_pattern = re.compile(r'([sS]\d{2}[eE]\d{2})')
+        self.parser = settings.parser
+        # Fail now rather than on every search if lxml is missing
+        make_soup('', self.parser)
         if settings.download_folder:
             self.download_folder = settings.download_folder
         else:
             self.download_folder = None
         self.headers = {
             'User-Agent': 'Mozilla/5.0 (Windows NT 6.0; WOW64; rv:24.0) Gecko/20100101 Firefox/24.0'}
+        self.log_lock = threading.Lock()
+        connections = settings.connections
+        self.sessions = {
+            'search_engine': self.create_session(
+                connections['search_engine']),
+            'torrent_host': self.create_session(
+                connections['torrent_host'], headers=self.headers),
+            'torrent_client': self.create_session(
+                connections['torrent_client'],
+                auth=HTTPDigestAuth(self.username, self.password))}
+        search_cache = settings.search_cache
+        self.cache = SearchCache(
+            ttl=float(search_cache['ttl']), size=int(search_cache['size']),
+            enabled=kwargs.get('use_cache', True))
+        self.catch_up = kwargs.get('catch_up', settings.catch_up)
+        self.scheduler = RetryScheduler(
+            self.retries, float(settings.backoff),
+            float(settings.max_backoff))
+        self.rate_limiter = RateLimiter(
+            float(settings.search_rate), float(settings.search_burst))
+        self.check_all = kwargs.get('check_all', False)
+        self.idle_backoff = float(settings.idle_backoff)
+        self.max_idle_backoff = float(settings.max_idle_backoff)
+        self.schedule = self.load_schedule(settings.schedule_file)
+        self.skipped = 0
+        self.report_file = settings.report_file
+        self.metrics = Metrics()
+        self.ranking = {'min_seeds': float(settings.min_seeds),
+                        'min_size': float(settings.min_size),
+                        'max_size': float(settings.max_size)}
+        self.push_batch = max(1, int(settings.push_batch))
+        self.torrents = TorrentIndex(
+            settings.torrent_index,
+            capacity=int(settings.torrent_index_capacity))
+        self.push_queue = settings.push_queue
+        self.start_push()
 
-    def change_dir(self, dirname):
-        if dirname not in os.getcwd():
-            try:
-                os.chdir(dirname)
-            except:
-                os.mkdir(dirname)
-                os.chdir(dirname)
-        return
+    def create_session(self, connection_settings, **kwargs):
+        from remote import RemoteSession
+        return RemoteSession(
+            pool_size=int(connection_settings['pool_size']),
+            timeout=float(connection_settings['timeout']), **kwargs)
+
+    def connection_stats(self):
+        '''Return connections opened and requests made for each remote'''
+        return dict((remote, session.stats())
+                    for remote, session in self.sessions.items())
+
+    def close(self):
+        for session in self.sessions.values():
+            session.close()
+        self.torrents.close()
 
     def push_magnet_link(self, magnet_link):
         '''Push the magnet url to a remote torrent client'''
-        response = requests.post(
-            self.download_url, {'urls': magnet_link},
-            auth=HTTPDigestAuth(self.username, self.password))
-        if not response.ok:
-            response.raise_for_status()
-        response.content
+        with self.metrics.timer(
+                'push', urlparse(self.download_url).netloc) as sample:
+            response = self.sessions['torrent_client'].post(
+                self.download_url, {'urls': magnet_link})
+            if not response.ok:
+                response.raise_for_status()
+            sample['bytes'] = len(response.content)
+
+    def queue_magnet(self, magnet_link):
+        '''Queue a magnet for the remote client unless it was downloaded
+        before. Return the batch to push once push_batch magnets are
+        waiting'''
+        if magnet_link in self.pending_magnets:
+            pass
+        elif magnet_link in self.torrents:
+            self.log('{0} already downloaded, skipped'.format(
+                info_hash(magnet_link)))
+        else:
+            self.pending_magnets.append(magnet_link)
+        if len(self.pending_magnets) >= self.push_batch:
+            return self.take_pending_magnets()
+        return []
+
+    def take_pending_magnets(self):
+        magnets, self.pending_magnets = self.pending_magnets, []
+        return magnets
+
+    def start_push(self):
+        '''Forget the magnets of the last run, they are in the push_queue'''
+        self.pending_magnets = []
+        self.deferred_magnets = []
+        self.client_failing = False
+
+    def push_magnets(self, magnets):
+        '''Push the magnets in a single request. A batch the client rejects
+        is split in halves until the rejected magnets are found, those are
+        logged and the rest pushed. When the client fails otherwise, the
+        magnets are kept in the push_queue for the next run'''
+        import requests
+        if not magnets:
+            return
+        if self.client_failing:
+            # Don't insist on this run
+            self.deferred_magnets.extend(magnets)
+            return
+        try:
+            self.push_magnet_link('\n'.join(magnets))
+        except requests.HTTPError as error:
+            status = getattr(error.response, 'status_code', None)
+            if status not in PUSH_REJECTED:
+                return self.defer_magnets(magnets, error)
+            if len(magnets) == 1:
+                self.log('{0} rejected by the torrent client ({1})'.format(
+                    magnets[0], error))
+                return
+            middle = len(magnets) // 2
+            self.push_magnets(magnets[:middle])
+            self.push_magnets(magnets[middle:])
+            return
+        except transient_errors() as error:
+            return self.defer_magnets(magnets, error)
+        self.torrents.add(magnets)
+
+    def defer_magnets(self, magnets, error):
+        self.log('torrent client failed ({0}), {1} magnets kept for the '
+                 'next run'.format(error, len(magnets)))
+        self.client_failing = True
+        self.deferred_magnets.extend(magnets)
+
+    def load_push_queue(self):
+        '''The magnets left unpushed by the last run'''
+        try:
+            with open(self.push_queue) as queue_file:
+                return json.load(queue_file)
+        except (IOError, ValueError):
+            return []
+
+    def save_push_queue(self):
+        queue, seen = [], set()
+        for magnet in self.deferred_magnets:
+            if info_hash(magnet) not in seen:
+                seen.add(info_hash(magnet))
+                queue.append(magnet)
+        if queue:
+            atomic_write(self.push_queue, json.dumps(queue))
+        elif os.path.exists(self.push_queue):
+            os.remove(self.push_queue)
+
+    def push_queued_magnets(self):
+        '''Push what the last run couldn't, push_batch at a time'''
+        queue = self.load_push_queue()
+        for start in range(0, len(queue), self.push_batch):
+            self.push_magnets(queue[start:start + self.push_batch])
 
     def run(self):
-        '''Runs the action defined on the settings file'''
-        torrent_list = self.gather_torrent_list()
-        magnet_list = [torrent['magnet_link'] for torrent in torrent_list]
+        '''Runs the action defined on the settings file. Each torrent goes
+        to the action as soon as it is found'''
+        self.metrics = Metrics()
+        self.start_push()
+        self.rewound = {}
+        folder = self.download_folder or ''
+        if self.action == 'download_torrent_files' and folder:
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+        # Nothing to stream into when only showing magnets, keep the order
+        ordered = self.action == 'show_magnets'
+        magnet_list = []
+        try:
+            if self.action == 'download_from_magnets' and not self.shard:
+                self.push_queued_magnets()
+            for torrent in self.iter_torrents(ordered=ordered):
+                magnet_list.append(torrent['magnet_link'])
+                if self.action == 'download_from_magnets':
+                    if 'magnet' in torrent['magnet_link']:
+                        self.push_magnets(
+                            self.queue_magnet(torrent['magnet_link']))
+                elif self.action == 'download_torrent_files':
+                    try:
+                        self.download_torrent_file(torrent, folder)
+                    except (IOError, OSError) as error:
+                        self.torrent_failed(torrent, error)
+            self.push_magnets(self.take_pending_magnets())
+        finally:
+            self.finish_gather()
         if self.action == 'show_magnets':
             return('\n'.join(magnet_list))
-        elif self.action == 'download_from_magnets':
-            for magnet in magnet_list:
-                if 'magnet' in magnet:
-                    self.push_magnet_link(magnet)
-        elif self.action == 'download_torrent_files':
-            old_dir = os.getcwd()
-            if self.download_folder:
-                self.change_dir(self.download_folder)
-            for t in torrent_list:
-                with open(t['name'] + '.torrent', 'wb') as file:
-                    file.write(
-                        requests.get(
-                            t['torrent_url'], headers=self.headers).content)
-            os.chdir(old_dir)
+
+    def download_torrent_file(self, torrent, folder=''):
+        '''Save the torrent file unless it was downloaded before'''
+        if torrent['magnet_link'] in self.torrents:
+            self.log('{0} already downloaded, skipped'.format(
+                torrent['name']))
+            return
+        self.save_torrent_file(torrent, folder)
+        self.torrents.add([torrent['magnet_link']], torrent['name'])
+
+    def torrent_failed(self, torrent, error):
+        '''Log a torrent file that could not be downloaded and move its
+        series back before that episode, for the next run to retry it'''
+        self.log('{0} download failed ({1}), left for the next run'.format(
+            torrent['name'], error))
+        serie = torrent['serie']
+        episode = self.series.previous_episode(torrent['episode'])
+        if serie not in self.rewound or episode < self.rewound[serie]:
+            self.rewound[serie] = episode
+            self.series.update_watchlist(serie, episode)
+
+    def run_shards(self, shards, engine=None, **options):
+        '''Runs the action over `shards` processes, each one with the series
+        whose name hashes to it. What they found is merged into the
+        watchlist in a single write, the series of a failed shard are left
+        as they were for the next run'''
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+        engine = engine or type(self)
+        changes, magnets, reports = {}, [], []
+        self.start_push()
+        if self.action == 'download_from_magnets':
+            self.push_queued_magnets()
+        with ProcessPoolExecutor(max_workers=shards) as pool:
+            futures = dict(
+                (pool.submit(run_shard, engine, options, shard, shards), shard)
+                for shard in range(shards))
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                except Exception as error:
+                    self.log('shard {0} of {1} failed ({2}), its series are '
+                             'left for the next run'.format(
+                                 futures[future] + 1, shards, error))
+                    continue
+                changes.update(result['changes'])
+                self.cache.merge(result['cache'])
+                reports.append(result['report'])
+                self.deferred_magnets.extend(result['deferred'])
+                if result['magnets']:
+                    magnets.append(result['magnets'])
+        self.series.merge(changes)
+        self.cache.save()
+        if self.action == 'download_from_magnets':
+            self.save_push_queue()
+        if self.report_file:
+            atomic_write(self.report_file, json.dumps({
+                'shards': shards,
+                'failed': shards - len(reports),
+                'reports': reports}, indent=2))
+        if self.action == 'show_magnets':
+            return '\n'.join(magnets)
+
+    def save_torrent_file(self, torrent, folder=''):
+        '''Download the torrent file into folder (defaults to current dir).
+        It is streamed into a .part file renamed once complete'''
+        filename = os.path.join(folder, torrent['name'] + '.torrent')
+        part = filename + '.part'
+        host = urlparse(torrent['torrent_url']).netloc
+        with self.metrics.timer('torrent', host) as sample:
+            response = self.sessions['torrent_host'].get(
+                torrent['torrent_url'], stream=True)
+            try:
+                response.raise_for_status()
+                with open(part, 'wb') as file:
+                    for chunk in response.iter_content(CHUNK_SIZE):
+                        file.write(chunk)
+                        sample['bytes'] += len(chunk)
+                getattr(os, 'replace', os.rename)(part, filename)
+            except:
+                if os.path.exists(part):
+                    os.remove(part)
+                raise
+            finally:
+                response.close()
 
     def gather_torrent_list(self):
-        '''Gather a torrent list for each series in download_list'''
-        result_list = []
-        for serie in self.download_list:
-            retried = 0
-            retry = True
-            while retried < self.retries and retry is True:
-                result = self.get_torrent(
-                    serie['name'], serie['next_episode'], serie['quality'])
-                retried += 1
-                if result:
-                    retry = False
-                    result_list.append(result)
-                    self.series.update_watchlist(
-                        serie['name'], result['episode'])
-            # If episode not found:
-            if retry is True:
-                self.log('{0} - {1} (may be quality) not found'.format(
-                    serie['name'], serie['next_episode']))
-        return result_list
+        '''Gather a torrent list for each series in download_list, in the
+        download_list order'''
+        return list(self.iter_torrents(ordered=True))
+
+    def iter_torrents(self, ordered=False):
+        '''Yield the torrents of each series in download_list as soon as
+        they are found. When settings.workers is greater than one the series
+        are searched concurrently, and unless ordered the torrents come in
+        the order they were found'''
+        due_list = self.due_series()
+        if self.workers <= 1:
+            for serie in due_list:
+                for torrent in self.gather_serie(serie):
+                    yield torrent
+            return
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        futures = [executor.submit(self.gather_serie, serie)
+                   for serie in due_list]
+        try:
+            for future in futures if ordered else as_completed(futures):
+                for torrent in future.result():
+                    yield torrent
+        finally:
+            # When the consumer fails, the searches not started are dropped
+            for future in futures:
+                future.cancel()
+            executor.shutdown()
+
+    def load_schedule(self, filename):
+        '''Load the optional air schedule, a json file mapping series names
+        to {episode: "YYYY-MM-DD"}'''
+        if not filename:
+            return {}
+        try:
+            with open(filename) as schedule_file:
+                return json.load(schedule_file)
+        except (IOError, ValueError):
+            self.log('air schedule {0} could not be read'.format(filename))
+            return {}
+
+    def due_series(self):
+        '''Return the series of download_list worth searching this run,
+        counting the ones skipped'''
+        now = time.time()
+        due_list = [serie for serie in self.download_list
+                    if self.check_all or self.is_due(serie, now)]
+        self.skipped = len(self.download_list) - len(due_list)
+        return due_list
+
+    def is_due(self, serie, now):
+        '''A series is due once its next episode has aired according to the
+        schedule. Without a schedule, each search in a row that found
+        nothing doubles the wait before the next one, from idle_backoff up
+        to max_idle_backoff seconds'''
+        episodes = self.schedule.get(serie['name'], {})
+        airs = episodes.get(serie['next_episode']) or \
+            episodes.get(serie['next_season'])
+        if airs:
+            return airs <= date.today().isoformat()
+        if not serie.get('misses') or not self.idle_backoff:
+            return True
+        wait = min(self.max_idle_backoff,
+                   self.idle_backoff * 2 ** (serie['misses'] - 1))
+        return now - serie.get('last_checked', 0) >= wait
+
+    def gather_serie(self, serie):
+        '''Return the torrents to download for a series of download_list'''
+        start = time.time()
+        try:
+            if self.catch_up:
+                torrents = self.gather_season(serie)
+            else:
+                torrents = [self.gather_torrent(serie)]
+            torrents = [torrent for torrent in torrents if torrent]
+            for torrent in torrents:
+                torrent['serie'] = serie['name']
+            return torrents
+        finally:
+            self.metrics.record_serie(serie['name'], time.time() - start)
+
+    def finish_gather(self):
+        '''Persist the watchlist and what the searches left behind, log the
+        cache stats and the series skipped and write the run report'''
+        self.series.flush()
+        self.torrents.save()
+        # The parent process of a sharded run saves what the shards return
+        if not self.shard:
+            self.cache.save()
+            self.mirrors.save()
+            if self.action == 'download_from_magnets':
+                self.save_push_queue()
+        self.log(self.cache.report())
+        self.log('skipped {0} of {1} series (idle or not aired yet)'.format(
+            self.skipped, len(self.download_list)))
+        if self.report_file and not self.shard:
+            atomic_write(self.report_file,
+                         json.dumps(self.run_report(), indent=2))
+
+    def run_report(self):
+        '''A machine readable report of the run'''
+        report = self.metrics.report()
+        report.update({
+            'action': self.action,
+            'series': len(self.download_list),
+            'skipped': self.skipped,
+            'search_cache': dict(self.cache.stats),
+            'connections': self.connection_stats()})
+        if len(self.mirrors) > 1:
+            report['mirrors'] = self.mirrors.stats
+        return report
+
+    def gather_torrent(self, serie):
+        '''Search a single series from download_list. Only failed searches
+        are retried, an episode not found is left for the next run'''
+        try:
+            result = self.get_torrent(
+                serie['name'], serie['next_episode'], self.preferences(serie))
+        except transient_errors() as error:
+            self.log_search_failed(serie, error)
+            return None
+        self.series.record_check(serie['name'], bool(result))
+        if result:
+            self.series.update_watchlist(serie['name'], result['episode'])
+            return result
+        # If episode not found:
+        self.log('{0} - {1} (may be quality) not found'.format(
+            serie['name'], serie['next_episode']))
+
+    def gather_season(self, serie):
+        '''Catch up on a series with a season search. The watchlist is
+        moved to the highest episode found without gaps'''
+        try:
+            torrents = self.get_season(
+                serie['name'], serie['next_episode'], self.preferences(serie))
+        except transient_errors() as error:
+            self.log_search_failed(serie, error)
+            return []
+        self.series.record_check(serie['name'], bool(torrents))
+        if torrents:
+            episodes = [torrent['episode'] for torrent in torrents]
+            episode = serie['next_episode']
+            if episode[:3] != episodes[0][:3]:
+                episode = self.series.next_season(episode)
+            latest = None
+            while episode in episodes:
+                latest = episode
+                episode = self.series.next_episode(episode)
+            if latest:
+                self.series.update_watchlist(serie['name'], latest)
+            return torrents
+        self.log('{0} - {1} (may be quality) not found'.format(
+            serie['name'], serie['next_episode']))
+        return []
+
+    def preferences(self, serie):
+        '''The Preferences of a series from download_list, the settings
+        give the bounds its watchlist entry doesn't set'''
+        bounds = {}
+        for key, default in self.ranking.items():
+            value = serie.get(key)
+            bounds[key] = default if value is None else float(value)
+        return Preferences(serie['quality'], **bounds)
+
+    def log_search_failed(self, serie, error):
+        self.log('{0} - {1} search failed ({2})'.format(
+            serie['name'], serie['next_episode'], error))
+
+    def get_season(self, name, episode, quality):
+        '''Return torrents for every episode from the given one to the end
+        of its season, or of the next season if there are none'''
+        try:
+            torrents = self.select_episodes(
+                self.search_for(name, episode[:3]), episode, quality)
+            if not torrents:
+                episode = self.series.next_season(episode)
+                torrents = self.select_episodes(
+                    self.search_for(name, episode[:3]), episode, quality)
+            return torrents
+        except transient_errors():
+            raise
+        except:
+            return []
+
+    def select_episodes(self, download_options, episode, quality):
+        '''Select a download for each episode of the season from the given
+        episode on'''
+        episodes = {}
+        for item in download_options:
+            if item['episode'][:3] == episode[:3] and \
+                    item['episode'] >= episode:
+                episodes.setdefault(item['episode'], []).append(item)
+        torrents = [self.select_download(episodes[found], quality)
+                    for found in sorted(episodes)]
+        return [torrent for torrent in torrents if torrent]
 
     def get_torrent(self, name, episode, quality):
         '''Return torrent for the given series and episode'''
@@ -101,34 +1054,119 @@ class Downloader(object):
                     self.search_for(
                         name, self.series.next_season(episode)), quality)
             return download
+        except transient_errors():
+            raise
         except:
             return None
 
-    def search_for(self, name, episode):
+    def search_for(self, name, episode, limit=None):
         '''Search for the tv series name and episode'''
+        url = self.search_url(name, episode)
+        cached = self.cache.lookup(url)
+        if cached is not None:
+            return cached
+        if len(self.mirrors) > 1:
+            return self.race_mirrors(url, name, episode, limit)
+        request = self.fetch_search(url)
+        return self.parse_search(url, request, name, episode, limit)
+
+    def race_mirrors(self, url, name, episode, limit):
+        '''Send the search to the `mirror_hedge` best ranked mirrors at once
+        and return the first answer that parses, trying the next mirrors
+        if none does. url is the key of the search on the cache. Only the
+        winning answer is parsed and cached, the others are only timed'''
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+        ranked = self.mirrors.ranked()
+        error = None
+        for start in range(0, len(ranked), self.hedge):
+            executor = ThreadPoolExecutor(max_workers=self.hedge)
+            futures = [executor.submit(self.search_mirror, engine, url, name,
+                                       episode)
+                       for engine in ranked[start:start + self.hedge]]
+            try:
+                for future in as_completed(futures):
+                    try:
+                        return self.parse_search(
+                            url, future.result(), name, episode, limit)
+                    except Exception as failure:
+                        error = failure
+            finally:
+                # The slower mirrors still running are left to finish alone
+                for future in futures:
+                    future.cancel()
+                executor.shutdown(wait=False)
+        raise error
+
+    def search_mirror(self, engine, url, name, episode):
+        '''Return the answer of engine to the search, recording its
+        latency or its failure on the mirror ranking. As for a single
+        engine, only 429, 5xx and connection errors are failures, a 404
+        is an answer with nothing found'''
+        start = time.time()
+        try:
+            request = self.fetch_search(
+                self.search_url(name, episode, engine), key=url)
+        except Exception:
+            self.mirrors.record(engine)
+            raise
+        self.mirrors.record(engine, time.time() - start)
+        return request
+
+    def fetch_search(self, url, key=None):
+        '''GET a search url, retrying transient failures. key is the url
+        the search is cached under, when it differs'''
+        return self.scheduler.call(self.request_search, url, key or url)
+
+    def request_search(self, url, key):
+        host = urlparse(url).netloc
+        self.rate_limiter.acquire(host)
+        with self.metrics.timer('search', host) as sample:
+            request = self.sessions['search_engine'].get(
+                url, headers=self.cache.conditional_headers(key))
+            sample['bytes'] = len(request.content)
+            if request.status_code == 429 or request.status_code >= 500:
+                raise TransientError(request)
+        return request
+
+    def search_url(self, name, episode, engine=None):
         query = '"' + name + '.' + episode + '"'
-        request = requests.get(self.search_engine + query + '/')
+        return (engine or self.search_engine) + query + '/'
+
+    def parse_search(self, url, request, name, episode, limit=None):
+        '''Return the download options found on a search response'''
+        if request.status_code == 304:
+            return self.cache.revalidate(url)
         download_options = []
         if request.status_code == 200:
-            soup = BeautifulSoup(request.content, 'html.parser')
-            download_options = self.fetch_download_table(soup, name, episode)
+            with self.metrics.timer('parse') as sample:
+                sample['bytes'] = len(request.content)
+                soup = make_soup(request.content, self.parser)
+                download_options = self.fetch_download_table(
+                    soup, name, episode, limit)
+            self.cache.store(url, download_options, request)
         return download_options
 
-    def fetch_download_table(self, soup, serie, episode, limit=5):
-        '''Crawls the searched webpage and return a list of download options'''
+    def fetch_download_table(self, soup, serie, episode, limit=None):
+        '''Crawls the searched webpage and return a list of download options,
+        from the first `limit` rows or the whole table'''
         table = soup.findAll('table')[1].findAll('tr')
+        rows = table[1:limit + 1] if limit else table[1:]
         download_list = []
-        for row in table[1:limit + 1]:
+        # The same torrent may be listed again, under another quality
+        seen = set()
+        for row in rows:
             try:
-                magnet_link = row.findAll('td')[0].find(
+                cells = row.findAll('td')
+                magnet_link = cells[0].find(
                     'a', {'title': 'Torrent magnet link'}).attrs['href']
-                torrent_file = row.findAll('td')[0].find(
+                torrent_file = cells[0].find(
                     'a', {'title': 'Download torrent file'}).attrs['href']
-                main_link = row.findAll('td')[0].find(
+                main_link = cells[0].find(
                     'a', {'class': 'cellMainLink'}).attrs['href']
-                size = row.findAll('td')[-5].contents[0]
-                seeds = row.findAll('td')[-2].contents[0]
-                quality = re.findall('(\d{3,4}p)', magnet_link)
+                # Plain strings, a NavigableString keeps the whole page alive
+                size = megabytes(cells[-5].get_text())
+                seeds = cells[-2].contents[0].strip()
+                quality = QUALITY_PATTERN.findall(magnet_link)
                 if quality:
                     quality = quality[0]
                 elif float(size) >= 110.00 and float(size) <= 380.00:
@@ -136,10 +1174,15 @@ class Downloader(object):
 
                 maches_serie = serie.replace('.', '+').lower() in magnet_link
                 matches_episode = episode.lower() in magnet_link
-                if maches_serie and matches_episode:
+                duplicate = info_hash(magnet_link) in seen
+                seen.add(info_hash(magnet_link))
+                if maches_serie and matches_episode and not duplicate:
+                    # Season searches (Name.S03) match many episodes
+                    found = self.ep_pattern.findall(magnet_link)
+                    found = found[0].upper() if found else episode
                     download_list.append({
-                        'name': serie + '.' + episode,
-                        'episode': episode,
+                        'name': serie + '.' + found,
+                        'episode': found,
                         'magnet_link': magnet_link,
                         'torrent_file': torrent_file,
                         'main_link': main_link,
@@ -151,8 +1194,13 @@ class Downloader(object):
         return download_list
 
     def select_download(self, download_options, quality):
-        for item in download_options:
-            if item['quality'] == quality:
+        '''The best ranked option for the Preferences, or a quality name'''
+        with self.metrics.timer('select'):
+            if not isinstance(quality, Preferences):
+                quality = Preferences(quality, **self.ranking)
+            ranked = quality.rank(download_options)
+            if ranked:
+                item = ranked[0]
                 return {
                     'name': item['name'],
                     'episode': item['episode'],
@@ -162,8 +1210,9 @@ class Downloader(object):
     def log(self, line):
         now = datetime.now().strftime('%d/%m/%Y (%H:%M:%S)\n')
         try:
-            with open('log.txt', 'a+') as file:
-                file.write(' - '.join([line, now]))
+            with self.log_lock:
+                with open('log.txt', 'a+') as file:
+                    file.write(' - '.join([line, now]))
         except:
             pass
 
@@ -171,11 +1220,20 @@ class Downloader(object):
 class Watchlist(object):
     '''Create a watchlist object containing a list of tv series and
     desired quality. Also tv series can be set to download False so it won't
-    be seen by the Downloader'''
+    be seen by the Downloader.
+
+    Changes are kept in memory until flush() rewrites watchlist.json. With
+    journal (the default) every found episode is also appended to
+    watchlist.journal, which load_watchlist replays, so nothing is lost if
+    the app stops before flushing'''
     series_folder = ''
     watchlist = {}
+    journal_file = 'watchlist.journal'
 
     def __init__(self, *args, **kwargs):
+        self.lock = threading.Lock()
+        self.journal = kwargs.get('journal', True)
+        self.dirty = False
         self.sl = kwargs.get('series_list', [])
         self.sf = []
         if kwargs.get('folder', ''):
@@ -185,6 +1243,7 @@ class Watchlist(object):
         self.watchlist = self.load_watchlist()
         for tvserie in self.series_list:
             self.create_tvseries(tvserie)
+        self.flush()
 
     def create_tvseries(self, name):
         if name not in self.watchlist:
@@ -194,22 +1253,50 @@ class Watchlist(object):
                 'latest-downloaded-episode': 'S01E00'
             }}
             self.watchlist.update(new_tvserie)
-            self.save_watchlist()
+            self.dirty = True
 
     def load_watchlist(self):
         try:
             with open('watchlist.json') as watchlist_file:
                 watchlist = json.load(watchlist_file)
         except IOError:
-            watchlist = self.create_raw_watchlist()
+            return self.create_raw_watchlist()
+        self.replay_journal(watchlist)
         return watchlist
 
-    def save_watchlist(self):
+    def replay_journal(self, watchlist):
+        '''Apply the episodes journaled since watchlist.json was saved'''
         try:
-            with open('watchlist.json', 'w') as watchlist_file:
-                json.dump(self.watchlist, watchlist_file)
-        except Exception as e:
-            raise e
+            with open(self.journal_file) as journal:
+                lines = journal.readlines()
+        except IOError:
+            return
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # A line cut short by a crash, the ones before it are fine
+                break
+            if entry['name'] in watchlist:
+                watchlist[entry['name']]['latest-downloaded-episode'] = \
+                    entry['episode']
+                self.dirty = True
+
+    def save_watchlist(self):
+        atomic_write('watchlist.json', json.dumps(self.watchlist))
+
+    def flush(self):
+        '''Write pending changes to watchlist.json and empty the journal'''
+        with self.lock:
+            if not self.dirty:
+                return
+            self.save_watchlist()
+            if os.path.exists(self.journal_file):
+                os.remove(self.journal_file)
+            self.dirty = False
+
+    def close(self):
+        '''Nothing to release, the watchlist file is not kept open'''
 
     def load_downloadable_watchlist(self):
         '''Retrieve a list of tv series flagged to Download from watchlist'''
@@ -217,7 +1304,12 @@ class Watchlist(object):
             {'name': k,
              'quality': v['quality'],
              'next_episode': self.next_episode(v['latest-downloaded-episode']),
-             'next_season': self.next_season(v['latest-downloaded-episode'])}
+             'next_season': self.next_season(v['latest-downloaded-episode']),
+             'last_checked': v.get('last-checked', 0),
+             'misses': v.get('misses', 0),
+             'min_seeds': v.get('min-seeds'),
+             'min_size': v.get('min-size'),
+             'max_size': v.get('max-size')}
             for k, v in self.watchlist.items() if v['download'] is True]
         return download_list
 
@@ -229,16 +1321,38 @@ class Watchlist(object):
                 'quality': 'SD',
                 'latest-downloaded-episode': 'S01E00'
             }})
-        with open('watchlist.json', 'w') as watchlist_file:
-            json.dump(watchlist, watchlist_file)
+        atomic_write('watchlist.json', json.dumps(watchlist))
+        # A journal left behind belongs to the watchlist that was removed
+        if os.path.exists(self.journal_file):
+            os.remove(self.journal_file)
         return watchlist
 
     def update_watchlist(self, key, episode):
-        try:
+        '''Set the latest downloaded episode, safe to call from workers'''
+        with self.lock:
             self.watchlist[key]['latest-downloaded-episode'] = episode
-            self.save_watchlist()
-        except Exception as e:
-            raise e
+            self.dirty = True
+            if self.journal:
+                with open(self.journal_file, 'a') as journal:
+                    journal.write(
+                        json.dumps({'name': key, 'episode': episode}) + '\n')
+
+    def record_check(self, key, found):
+        '''Remember when a series was searched and for how many searches in
+        a row it had nothing new'''
+        with self.lock:
+            serie = self.watchlist[key]
+            serie['last-checked'] = int(time.time())
+            serie['misses'] = 0 if found else serie.get('misses', 0) + 1
+            self.dirty = True
+
+    def merge(self, changes):
+        '''Apply the changes of a sharded run and write them at once'''
+        with self.lock:
+            for key, fields in changes.items():
+                self.watchlist[key].update(fields)
+            self.dirty = self.dirty or bool(changes)
+        self.flush()
 
     def next_episode(self, episode):
         return (episode[:-2] + str(int(episode[-2:]) + 1).zfill(2)).upper()
@@ -246,6 +1360,362 @@ class Watchlist(object):
     def next_season(self, episode):
         return ('s' + str(int(episode[1:3]) + 1).zfill(2) + 'e01').upper()
 
+    def previous_episode(self, episode):
+        return (episode[:-2] + str(int(episode[-2:]) - 1).zfill(2)).upper()
+
+
+class SQLiteWatchlist(Watchlist):
+    '''A Watchlist stored in a SQLite database, for watchlists too big to
+    load whole. Only the series flagged to download are read on startup and
+    every update is its own transaction, so there is nothing to flush.
+    Fields other than download, quality and latest-downloaded-episode are
+    kept as json in the extra column'''
+    schema = [
+        '''CREATE TABLE IF NOT EXISTS series (
+            name TEXT PRIMARY KEY,
+            download INTEGER NOT NULL DEFAULT 1,
+            quality TEXT NOT NULL DEFAULT 'SD',
+            latest_episode TEXT NOT NULL DEFAULT 'S01E00',
+            extra TEXT NOT NULL DEFAULT '{}')''',
+        'CREATE INDEX IF NOT EXISTS series_download ON series (download)',
+        'CREATE INDEX IF NOT EXISTS series_quality ON series (quality)',
+    ]
+    columns = {'download': 'download', 'quality': 'quality',
+               'latest-downloaded-episode': 'latest_episode'}
+
+    def __init__(self, filename='watchlist.db', **kwargs):
+        import sqlite3
+        self.lock = threading.Lock()
+        self.filename = filename
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        with self.connection:
+            for statement in self.schema:
+                self.connection.execute(statement)
+        self.sl = kwargs.get('series_list', [])
+        self.sf = []
+        if kwargs.get('folder', ''):
+            self.sf = os.listdir(kwargs.get('folder'))
+        self.series_list = [
+            '.'.join(name.split(' ')) for name in self.sl + self.sf]
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO series (name) VALUES (?)',
+                [(name,) for name in self.series_list])
+
+    @property
+    def watchlist(self):
+        return self.load_watchlist()
+
+    def create_tvseries(self, name):
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR IGNORE INTO series (name) VALUES (?)', (name,))
+
+    def load_watchlist(self):
+        '''Return the whole watchlist in the watchlist.json format'''
+        watchlist = {}
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT name, download, quality, latest_episode, extra '
+                'FROM series ORDER BY name').fetchall()
+        for name, download, quality, episode, extra in rows:
+            serie = json.loads(extra)
+            serie.update({'download': bool(download), 'quality': quality,
+                          'latest-downloaded-episode': episode})
+            watchlist[name] = serie
+        return watchlist
+
+    def load_downloadable_watchlist(self):
+        '''Retrieve a list of tv series flagged to Download from watchlist'''
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT name, quality, latest_episode, extra FROM series '
+                'WHERE download = 1 ORDER BY name').fetchall()
+        download_list = []
+        for name, quality, episode, extra in rows:
+            extra = json.loads(extra)
+            download_list.append({
+                'name': name,
+                'quality': quality,
+                'next_episode': self.next_episode(episode),
+                'next_season': self.next_season(episode),
+                'last_checked': extra.get('last-checked', 0),
+                'misses': extra.get('misses', 0),
+                'min_seeds': extra.get('min-seeds'),
+                'min_size': extra.get('min-size'),
+                'max_size': extra.get('max-size')})
+        return download_list
+
+    def update_watchlist(self, key, episode):
+        '''Set the latest downloaded episode, safe to call from workers'''
+        with self.lock, self.connection:
+            cursor = self.connection.execute(
+                'UPDATE series SET latest_episode = ? WHERE name = ?',
+                (episode, key))
+        if not cursor.rowcount:
+            raise KeyError(key)
+
+    def record_check(self, key, found):
+        with self.lock, self.connection:
+            row = self.connection.execute(
+                'SELECT extra FROM series WHERE name = ?', (key,)).fetchone()
+            if row is None:
+                raise KeyError(key)
+            extra = json.loads(row[0])
+            extra['last-checked'] = int(time.time())
+            extra['misses'] = 0 if found else extra.get('misses', 0) + 1
+            self.connection.execute(
+                'UPDATE series SET extra = ? WHERE name = ?',
+                (json.dumps(extra), key))
+
+    def merge(self, changes):
+        '''Apply the changes of a sharded run in a single transaction'''
+        with self.lock, self.connection:
+            for key, fields in changes.items():
+                row = self.connection.execute(
+                    'SELECT latest_episode, extra FROM series WHERE name = ?',
+                    (key,)).fetchone()
+                if row is None:
+                    continue
+                extra = json.loads(row[1])
+                extra.update((k, v) for k, v in fields.items()
+                             if k not in self.columns)
+                self.connection.execute(
+                    'UPDATE series SET latest_episode = ?, extra = ? '
+                    'WHERE name = ?',
+                    (fields.get('latest-downloaded-episode', row[0]),
+                     json.dumps(extra), key))
+
+    def flush(self):
+        pass
+
+    def import_json(self, filename='watchlist.json'):
+        '''Add or replace the series of a watchlist.json file'''
+        with open(filename) as watchlist_file:
+            watchlist = json.load(watchlist_file)
+        rows = []
+        for name, serie in watchlist.items():
+            extra = dict((k, v) for k, v in serie.items()
+                         if k not in self.columns)
+            rows.append((name, bool(serie.get('download', True)),
+                         serie.get('quality', 'SD'),
+                         serie.get('latest-downloaded-episode', 'S01E00'),
+                         json.dumps(extra)))
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO series (name, download, quality, '
+                'latest_episode, extra) VALUES (?, ?, ?, ?, ?)', rows)
+        return len(rows)
+
+    def export_json(self, filename='watchlist.json'):
+        '''Write the whole watchlist as a watchlist.json file'''
+        atomic_write(filename, json.dumps(self.load_watchlist()))
+
+    def close(self):
+        self.connection.close()
+
+
+class WatchlistChanges(object):
+    '''Stands in for the watchlist in the process of a shard. The episodes
+    found and the searches made are only collected, for the parent process
+    to merge them'''
+
+    def __init__(self, series, download_list):
+        self.series = series
+        self.misses = dict((serie['name'], serie['misses'])
+                           for serie in download_list)
+        self.changes = {}
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.series, name)
+
+    def update_watchlist(self, key, episode):
+        with self.lock:
+            self.changes.setdefault(key, {})[
+                'latest-downloaded-episode'] = episode
+
+    def record_check(self, key, found):
+        with self.lock:
+            self.misses[key] = 0 if found else self.misses.get(key, 0) + 1
+            self.changes.setdefault(key, {}).update({
+                'last-checked': int(time.time()),
+                'misses': self.misses[key]})
+
+    def flush(self):
+        pass
+
+
+def shard_of(name, shards):
+    '''The shard of a series, stable across processes and runs unlike
+    hash()'''
+    return (zlib.crc32(name.encode('utf-8')) & 0xffffffff) % shards
+
+
+def run_shard(engine, options, shard, shards):
+    '''Run one shard of a sharded run, in a worker process'''
+    downloader = engine(shard=(shard, shards), **options)
+    try:
+        magnets = downloader.run()
+        return {'changes': downloader.series.changes,
+                'magnets': magnets,
+                'cache': downloader.cache.entries,
+                'deferred': downloader.deferred_magnets,
+                'report': downloader.run_report()}
+    finally:
+        downloader.close()
+
+
+def open_watchlist(settings, **kwargs):
+    '''Return the watchlist store selected by settings.watchlist_store'''
+    if settings.watchlist_store == 'sqlite':
+        return SQLiteWatchlist(settings.watchlist_db, **kwargs)
+    return Watchlist(journal=settings.watchlist_journal, **kwargs)
+
+
+class Daemon(object):
+    '''Keeps a Downloader warm in memory (sessions, caches and watchlist)
+    and runs it every settings.daemon_interval seconds plus a random jitter
+    of up to settings.daemon_jitter. Settings and watchlist files are only
+    read again when they were changed by someone else. SIGUSR1, or "run" sent
+    to the control port (settings.daemon_port), starts a run right away'''
+    command_timeout = 10
+
+    def __init__(self, engine=None, **options):
+        self.engine = engine or Downloader
+        self.options = options
+        self.downloader = None
+        self.mtimes = {}
+        self.runs = 0
+        self.stopping = False
+        self.wakeup = threading.Event()
+        self.control = None
+
+    def watched_files(self, settings):
+        if settings.watchlist_store == 'sqlite':
+            return ['settings.json', settings.watchlist_db]
+        return ['settings.json', 'watchlist.json']
+
+    def changed_files(self, settings):
+        return [filename for filename in self.watched_files(settings)
+                if self.mtimes.get(filename) != self.mtime(filename)]
+
+    def mtime(self, filename):
+        try:
+            return os.stat(filename).st_mtime
+        except OSError:
+            return None
+
+    def remember_files(self, settings):
+        self.mtimes = dict((filename, self.mtime(filename))
+                           for filename in self.watched_files(settings))
+
+    def refresh(self):
+        '''Get the Downloader ready for a run, rebuilding only what was
+        changed since the last one'''
+        settings = Settings()
+        changed = self.changed_files(settings)
+        if self.downloader is None or 'settings.json' in changed:
+            self.close_downloader()
+            self.downloader = self.engine(**self.options)
+        elif changed:
+            self.downloader.series.close()
+            self.downloader.series = open_watchlist(settings)
+        self.downloader.download_list = \
+            self.downloader.series.load_downloadable_watchlist()
+        return settings
+
+    def close_downloader(self):
+        if self.downloader is not None:
+            self.downloader.series.close()
+            self.downloader.close()
+
+    def run_once(self):
+        settings = self.refresh()
+        try:
+            self.downloader.run()
+        except Exception as e:
+            self.downloader.log('daemon run failed: {0!r}'.format(e))
+        self.runs += 1
+        self.remember_files(settings)
+
+    def next_wait(self):
+        settings = Settings()
+        return float(settings.daemon_interval) + random.uniform(
+            0, float(settings.daemon_jitter))
+
+    def serve(self):
+        '''Run until stopped by a signal or a "stop" command'''
+        if threading.current_thread().name == 'MainThread':
+            if hasattr(signal, 'SIGUSR1'):
+                signal.signal(signal.SIGUSR1, lambda *args: self.trigger())
+            signal.signal(signal.SIGTERM, lambda *args: self.stop())
+        port = Settings().daemon_port
+        if port:
+            self.listen(int(port))
+        try:
+            while not self.stopping:
+                self.run_once()
+                if not self.stopping:
+                    self.wakeup.wait(self.next_wait())
+                    self.wakeup.clear()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+            self.close_downloader()
+
+    def trigger(self):
+        self.wakeup.set()
+
+    def stop(self):
+        self.stopping = True
+        self.wakeup.set()
+        if self.control is not None:
+            self.control.close()
+            self.control = None
+
+    def listen(self, port):
+        '''Accept "run" and "stop" commands on a local port'''
+        self.control = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.control.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.control.bind(('127.0.0.1', port))
+        self.control.listen(5)
+        thread = threading.Thread(
+            target=self.accept_commands, args=(self.control,))
+        thread.daemon = True
+        thread.start()
+
+    def accept_commands(self, control):
+        while not self.stopping:
+            try:
+                connection, address = control.accept()
+            except (socket.error, OSError):
+                return
+            # A client that never sends its command must not hold the port
+            connection.settimeout(self.command_timeout)
+            try:
+                command = connection.recv(64).decode('utf-8').strip()
+                if command == 'run':
+                    self.trigger()
+                elif command == 'stop':
+                    self.stop()
+                connection.sendall(b'ok\n')
+            except (socket.error, OSError):
+                pass
+            finally:
+                connection.close()
+
+
+def send_command(port, command):
+    '''Send a command to a Daemon's control port and return its answer'''
+    connection = socket.create_connection(('127.0.0.1', int(port)), 10)
+    try:
+        connection.sendall(command.encode('utf-8') + b'\n')
+        return connection.recv(64).decode('utf-8').strip()
+    finally:
+        connection.close()
+
 
 class Settings(object):
     '''Create a settings object for the Downloader'''
@@ -257,22 +1727,62 @@ class Settings(object):
             settings = self.create_raw_settings()
 
         if kwargs:
-            self.update_settings(**kwargs)
+            settings = self.update_settings(**kwargs)
 
+        # Settings files created by older versions may miss newer keys
+        defaults = self.default_settings()
+        defaults.update(settings)
+        settings = defaults
         for item in settings:
             setattr(self, item, settings[item])
 
     def update_settings(self, **kwargs):
+        '''Save kwargs into settings.json, which is left untouched when it
+        already holds them. Return the updated settings'''
         with open('settings.json', 'r') as settings_file:
             settings = json.load(settings_file)
+        if any(settings.get(key) != value for key, value in kwargs.items()):
             settings.update(**kwargs)
-        with open('settings.json', 'w') as settings_file:
-            json.dump(settings, settings_file)
+            atomic_write('settings.json', json.dumps(settings))
+        return settings
 
-    def create_raw_settings(self):
-        settings = {
+    @staticmethod
+    def default_settings():
+        return {
             'search_engine': 'http://kat.cr/usearch/',
+            'mirror_hedge': '2',
             'retries': '3',
+            'backoff': '1',
+            'max_backoff': '60',
+            'search_rate': '5',
+            'search_burst': '5',
+            'workers': '1',
+            'host_connections': '4',
+            'connections': {
+                'search_engine': {'pool_size': '10', 'timeout': '30'},
+                'torrent_host': {'pool_size': '10', 'timeout': '60'},
+                'torrent_client': {'pool_size': '2', 'timeout': '30'}
+            },
+            'search_cache': {'ttl': '3600', 'size': '5000'},
+            'parser': 'strainer',
+            'watchlist_journal': True,
+            'catch_up': False,
+            'idle_backoff': '3600',
+            'max_idle_backoff': '86400',
+            'schedule_file': '',
+            'daemon_interval': '3600',
+            'daemon_jitter': '300',
+            'daemon_port': '',
+            'report_file': 'run_report.json',
+            'min_seeds': '0',
+            'min_size': '0',
+            'max_size': '0',
+            'push_batch': '20',
+            'push_queue': 'push_queue.json',
+            'torrent_index': 'torrents.db',
+            'torrent_index_capacity': '1000000',
+            'watchlist_store': 'json',
+            'watchlist_db': 'watchlist.db',
             'action': 'download_torrent_files',
             'download_folder': '',
             'remote_settings': {
@@ -281,55 +1791,130 @@ class Settings(object):
                 'password': 'adminadmin'
             }
         }
+
+    def create_raw_settings(self):
+        settings = self.default_settings()
         with open('settings.json', 'w') as settings_file:
             json.dump(settings, settings_file)
         return settings
 
+
+ACTIONS_HELP = '''The run command performs the action defined in the settings file
+(defaults to download_torrent_files). Action can be set to:
+  download_torrent_files: Downloads found torrent files for tv series
+      in watchlist flagged to download: true.
+  show_magnets: Gather and print magnet urls for tv series
+      in watchlist flagged to download: true.
+  download_from_magnets: Push magnet urls to remote torrent client
+      for tv series in watchlist flagged to download: true.'''
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='downloader.py', epilog=ACTIONS_HELP,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        'command', nargs='?', choices=['run', 'daemon', 'trigger'],
+        help='run: execute the downloader based on your settings and '
+             'watchlist. If there\'s no settings or watchlist file the '
+             'downloader will create a new one based on its own folder. '
+             'daemon: keep running in the background, executing the '
+             'downloader every daemon_interval seconds, it takes the same '
+             'options as run. trigger: make a running daemon execute the '
+             'downloader now (needs daemon_port in the settings).')
+    parser.add_argument(
+        '-sl', metavar='SeriesNames,Separated,By,Commas',
+        help='create a raw watchlist based on the given tv series')
+    parser.add_argument(
+        '-sf', metavar='Folder',
+        help='create a raw watchlist based on a folder and its subfolders')
+    parser.add_argument(
+        '-ij', metavar='File',
+        help='import a watchlist json file into the sqlite watchlist '
+             '(settings watchlist_store: sqlite)')
+    parser.add_argument(
+        '-ej', metavar='File', help='export the sqlite watchlist as a json file')
+    parser.add_argument(
+        '-df', metavar='Folder',
+        help='define the download folder for the download_torrent_files '
+             'action (defaults to app\'s folder)')
+    parser.add_argument(
+        '-a', metavar='action', choices=[
+            'download_torrent_files', 'show_magnets', 'download_from_magnets'],
+        help='define the downloader action on Settings '
+             '(defaults to download_torrent_files)')
+    parser.add_argument(
+        '--async', dest='use_async', action='store_true',
+        help='use the asyncio engine, which streams each found torrent '
+             'straight into the action')
+    parser.add_argument(
+        '--no-cache', dest='use_cache', action='store_false',
+        help='ignore the search cache')
+    parser.add_argument(
+        '--catch-up', action='store_true',
+        help='get every new episode of a tv series at once, with a single '
+             'search per season')
+    parser.add_argument(
+        '--check-all', action='store_true',
+        help='also search the tv series that found nothing lately or are '
+             'not aired yet')
+    parser.add_argument(
+        '--shards', type=int, metavar='N',
+        help='split the run over N processes, for watchlists too big for '
+             'a single one')
+    parser.add_argument(
+        '--profile', action='store_true',
+        help='save a cProfile dump of the run to run.prof (see python -m '
+             'pstats run.prof), only the main thread is profiled so use '
+             'workers 1 for the full picture')
+    return parser, parser.parse_args(argv)
+
+
+def main(argv=None):
+    '''Dispatch the command line. Only run and daemon load the network and
+    parsing modules, the other commands stay fast'''
+    argv = sys.argv[1:] if argv is None else argv
+    parser, args = parse_args(argv)
+    if not argv:
+        parser.print_help()
+    if args.sl:
+        open_watchlist(Settings(), series_list=args.sl.split(','))
+    if args.sf:
+        open_watchlist(Settings(), folder=args.sf)
+    if args.ij:
+        SQLiteWatchlist(Settings().watchlist_db).import_json(args.ij)
+    if args.ej:
+        SQLiteWatchlist(Settings().watchlist_db).export_json(args.ej)
+    if args.df:
+        Settings(download_folder=args.df)
+    if args.a:
+        Settings(action=args.a)
+
+    if args.command in ('run', 'daemon'):
+        options = {'use_cache': args.use_cache}
+        if args.catch_up:
+            options['catch_up'] = True
+        if args.check_all:
+            options['check_all'] = True
+        engine = Downloader
+        if args.use_async:
+            from async_downloader import AsyncDownloader
+            engine = AsyncDownloader
+        if args.command == 'daemon':
+            Daemon(engine, **options).serve()
+        elif args.shards:
+            engine(**options).run_shards(args.shards, engine, **options)
+        elif args.profile:
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.runcall(engine(**options).run)
+            profiler.dump_stats('run.prof')
+        else:
+            engine(**options).run()
+
+    if args.command == 'trigger':
+        print(send_command(Settings().daemon_port, 'run'))
+
+
 if __name__ == '__main__':
-    # run the script with -sl <series,separated,by,commas> to create a raw
-    # watchlist based on the given tv series
-    if '-sl' in sys.argv and len(sys.argv) > 2:
-        Watchlist(series_list=sys.argv[sys.argv.index('-sl') + 1].split(','))
-
-    # run the script with -sf <folder> to create a raw watchlist
-    # based on a folder and its subfolders
-    if '-sf' in sys.argv and len(sys.argv) > 2:
-        Watchlist(folder=sys.argv[sys.argv.index('-sf') + 1])
-
-    # run the script with -df to define the download folder on Settings file
-    if '-df' in sys.argv and len(sys.argv) > 2:
-        Settings(download_folder=sys.argv[sys.argv.index('-df') + 1])
-
-    # run the script with -a to define the downloader action on Settings
-    if '-a' in sys.argv and len(sys.argv) > 2:
-        Settings(action=sys.argv[sys.argv.index('-a') + 1])
-
-    # use run argument to execute the downloader
-    if 'run' in sys.argv:
-        downloader = Downloader()
-        downloader.run()
-
-    # Provide help with options to use the downloader cli
-    if len(sys.argv) == 1:
-        print('''Please use one of the following options as arguments:
-            -sl <SeriesNames,Separated,By,Commas>: to create a raw watchlist
-                based on the given tv series.
-            -sf <Folder>: to create a raw watchlist based on a folder and
-                its subfolders.
-            -df <Folder>: to define the download folder for the
-                download_torrent_files action. (Defaults to app's folder)
-            -a <action>: define the downloader action on Settings.
-                (Defaults to download_torrent_files)
-            run: To execute the downloader based on your settings and
-                watchlist. If there's no settings or watchlist file the
-                downloader will create a new one based on
-                its own folder (Not Pretty).
-            The run argument is going to perform the action defined in the
-            settings file (defaults to download_torrent_files).
-            Action can be set to:
-            download_torrent_files: Downloads found torrent files for tv series
-                in watchlist flagged to download: true.
-            show_magnets: Gather and print magnet urls for tv series
-                in watchlist flagged to download: true.
-            download_from_magnets: Push magnet urls to remote torrent client
-                for tv series in watchlist flagged to download: true.''')
+    main()
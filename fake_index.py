@@ -0,0 +1,306 @@
+# coding: utf-8
+'''A local stand-in for the torrent index, used by the benchmarks and the
+offline tests so they don't depend on a live website'''
+import hashlib
+import os
+import re
+import threading
+import time
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, unquote
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib import unquote
+    from urlparse import parse_qs
+
+
+PAGE = '''<!DOCTYPE html>
+<html><head><title>{query} - fake index</title>
+<script type="text/javascript">var page = {{"query": "{query}"}};</script>
+</head><body>
+<div id="header"><ul class="menu">{menu}</ul></div>
+<table class="nav"><tr><td>fake index</td></tr></table>
+<table class="data">
+<tr class="firstr"><th>torrent name</th><th>size</th><th>files</th>
+<th>age</th><th>seed</th><th>leech</th></tr>
+{rows}
+</table>
+<div id="sidebar"><ul class="tags">{tags}</ul></div>
+<div id="footer"><p>fake index, made for tests and benchmarks</p></div>
+</body></html>'''
+
+MENU = ''.join('<li><a href="/{0}/">{0}</a></li>'.format(item) for item in (
+    'movies', 'tv', 'music', 'games', 'books', 'applications', 'anime'))
+
+TAGS = ''.join('<li><a href="/search/tag{0}/" class="tag{1}">tag {0}</a>'
+               '</li>'.format(n, n % 7) for n in range(150))
+
+ROW = '''<tr>
+<td><div class="iaconbox">
+<a title="Torrent magnet link" href="{magnet_link}">magnet</a>
+<a title="Download torrent file" href="{torrent_file}">torrent</a>
+</div>
+<a class="cellMainLink" href="{main_link}">{title}</a></td>
+<td class="nobr center">{size} <span>MB</span></td>
+<td class="center">1</td>
+<td class="center">1&nbsp;day</td>
+<td class="green center">{seeds}</td>
+<td class="red lasttd center">{leechs}</td>
+</tr>'''
+
+QUALITIES = (('1080p', '1400.00', 40), ('720p', '700.00', 120),
+             ('SD', '250.00', 300))
+
+QUERY_PATTERN = re.compile(r'^(.+)\.[sS](\d{2})(?:[eE](\d{2}))?$')
+
+DIGEST_FIELD = re.compile(r'(\w+)=(?:"([^"]*)"|([^,\s]*))')
+
+
+class FakeIndexServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+
+class FakeIndexHandler(BaseHTTPRequestHandler):
+    '''Serves kickass-like result pages under /usearch/<query>/, torrent
+    files under /torrent/ and a qBittorrent-like, digest protected,
+    /command/download endpoint'''
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        index = self.server.index
+        index.count_request()
+        if index.delay:
+            time.sleep(index.delay)
+        failure = index.next_failure()
+        if failure:
+            status, retry_after = failure
+            headers = {'Retry-After': str(retry_after)} if retry_after else {}
+            return self.reply(status, b'try again later', 'text/plain',
+                              headers)
+        if self.path.startswith('/usearch/'):
+            query = unquote(self.path[len('/usearch/'):]).strip('/"')
+            body = index.results_page(query, self.url()).encode('utf-8')
+            etag = '"{0}"'.format(hashlib.md5(body).hexdigest())
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', '0')
+                return self.end_headers()
+            return self.reply(200, body, 'text/html', {'ETag': etag})
+        if self.path.startswith('/torrent/'):
+            return self.reply(200, index.torrent_file(self.path),
+                              'application/x-bittorrent')
+        self.reply(404, b'not found', 'text/plain')
+
+    def do_POST(self):
+        index = self.server.index
+        index.count_request()
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode('utf-8')
+        if index.delay:
+            time.sleep(index.delay)
+        if self.path != '/command/download':
+            return self.reply(404, b'not found', 'text/plain')
+        if not index.authorized('POST', self.headers.get('Authorization')):
+            index.count_challenge()
+            self.send_response(401)
+            self.send_header('WWW-Authenticate', index.challenge())
+            self.send_header('Content-Length', '0')
+            return self.end_headers()
+        failure = index.next_failure()
+        if failure:
+            return self.reply(failure[0], b'try again later', 'text/plain')
+        urls = parse_qs(body).get('urls', [''])[0]
+        urls = [url for url in urls.split('\n') if url]
+        if index.rejects(urls):
+            return self.reply(415, b'Torrent file is not valid',
+                              'text/plain')
+        index.push(urls)
+        self.reply(200, b'Ok.', 'text/plain')
+
+    def url(self):
+        return '{0}:{1}'.format(*self.server.server_address[:2])
+
+    def reply(self, status, body, content_type, headers={}):
+        self.send_response(status)
+        for header, value in headers.items():
+            self.send_header(header, value)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeIndex(object):
+    '''A fake torrent index running on a background thread. Every series
+    has `seasons` seasons of `episodes` episodes, each released on SD, 720p
+    and 1080p. `delay` seconds are slept on every request to mimic the
+    network'''
+
+    realm = 'Web UI Access'
+    username = 'admin'
+    password = 'adminadmin'
+
+    def __init__(self, delay=0, seasons=3, episodes=10, port=0):
+        self.delay = delay
+        self.seasons = seasons
+        self.episodes = episodes
+        self.requests = 0
+        self.challenges = 0
+        self.failures = []
+        self.pushed = []
+        self.batches = 0
+        self.rejected = set()
+        self.nonce = hashlib.md5(os.urandom(16)).hexdigest()
+        self.lock = threading.Lock()
+        self.server = FakeIndexServer(('127.0.0.1', port), FakeIndexHandler)
+        self.server.index = self
+        self.thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    @property
+    def url(self):
+        return 'http://{0}:{1}'.format(*self.server.server_address[:2])
+
+    @property
+    def search_engine(self):
+        return self.url + '/usearch/'
+
+    @property
+    def download_url(self):
+        return self.url + '/command/download'
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count_request(self):
+        with self.lock:
+            self.requests += 1
+
+    def fail(self, status, count=1, retry_after=None):
+        '''Answer the next `count` requests with the given status'''
+        with self.lock:
+            self.failures.extend([(status, retry_after)] * count)
+
+    def next_failure(self):
+        with self.lock:
+            if self.failures:
+                return self.failures.pop(0)
+
+    def count_challenge(self):
+        with self.lock:
+            self.challenges += 1
+
+    def push(self, urls):
+        with self.lock:
+            self.batches += 1
+            self.pushed.extend(urls)
+
+    def reject(self, url):
+        '''Refuse every push holding url, as a client does a bad magnet'''
+        with self.lock:
+            self.rejected.add(url)
+
+    def rejects(self, urls):
+        with self.lock:
+            return bool(self.rejected.intersection(urls))
+
+    def challenge(self):
+        return ('Digest realm="{0}", nonce="{1}", qop="auth", '
+                'algorithm="MD5"'.format(self.realm, self.nonce))
+
+    def authorized(self, method, header):
+        '''Check a digest Authorization header against the fake client'''
+        if not header or not header.startswith('Digest '):
+            return False
+        fields = dict((key, quoted or bare) for key, quoted, bare
+                      in DIGEST_FIELD.findall(header[len('Digest '):]))
+        if fields.get('nonce') != self.nonce:
+            return False
+
+        def md5(text):
+            return hashlib.md5(text.encode('utf-8')).hexdigest()
+        ha1 = md5(':'.join([self.username, self.realm, self.password]))
+        ha2 = md5(':'.join([method, fields.get('uri', '')]))
+        expected = md5(':'.join([
+            ha1, self.nonce, fields.get('nc', ''), fields.get('cnonce', ''),
+            fields.get('qop', ''), ha2]))
+        return fields.get('response') == expected
+
+    def aired(self, season, episode):
+        return 1 <= season <= self.seasons and 1 <= episode <= self.episodes
+
+    def releases(self, name, season, episode):
+        '''Return the table rows for an episode, or none if not aired'''
+        if not self.aired(season, episode):
+            return []
+        ep = 'S{0:02d}E{1:02d}'.format(season, episode)
+        dotted = name.replace(' ', '.')
+        plus = dotted.replace('.', '+').lower()
+        rows = []
+        for quality, size, seeds in QUALITIES:
+            tag = '' if quality == 'SD' else '+' + quality
+            info_hash = hashlib.sha1(
+                (dotted + ep + quality).encode('utf-8')).hexdigest().upper()
+            rows.append({
+                'title': '{0} {1} {2}'.format(dotted, ep, quality),
+                'magnet_link': 'magnet:?xt=urn:btih:{0}&dn={1}+{2}{3}'
+                               '+x264'.format(info_hash, plus, ep.lower(),
+                                              tag),
+                'info_hash': info_hash,
+                'main_link': '/{0}-{1}-t{2}.html'.format(
+                    plus.replace('+', '-'), ep.lower(), info_hash[:8]),
+                'size': size,
+                'seeds': seeds,
+                'leechs': seeds // 3})
+        return rows
+
+    def search(self, query):
+        '''Return the releases matching a Name.SxxEyy or Name.Sxx query'''
+        match = QUERY_PATTERN.match(query)
+        if not match:
+            return []
+        name, season, episode = match.groups()
+        if episode is not None:
+            return self.releases(name, int(season), int(episode))
+        rows = []
+        for episode in range(1, self.episodes + 1):
+            rows.extend(self.releases(name, int(season), episode))
+        return rows
+
+    def torrent_file(self, path):
+        '''A small bencoded stand-in for a .torrent file'''
+        info_hash = path.split('/')[-1].split('.')[0]
+        return 'd4:infod4:name{0}:{1}ee'.format(
+            len(info_hash), info_hash).encode('utf-8')
+
+    def results_page(self, query, host):
+        rows = []
+        for release in self.search(query):
+            rows.append(ROW.format(
+                torrent_file='//{0}/torrent/{1}.torrent'.format(
+                    host, release['info_hash']),
+                **release))
+        return PAGE.format(query=query, menu=MENU, tags=TAGS,
+                           rows='\n'.join(rows))
@@ -0,0 +1,57 @@
+# coding: utf-8
+'''The keep-alive HTTP sessions of the Downloader. Kept apart from
+downloader.py so the commands that never go online don't import requests'''
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class CountingAdapter(HTTPAdapter):
+    '''An HTTPAdapter keeping count of the connections it opened and the
+    requests it sent, even for pools it has already discarded'''
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(CountingAdapter, self).init_poolmanager(*args, **kwargs)
+        self.retired = {'connections': 0, 'requests': 0}
+        dispose = self.poolmanager.pools.dispose_func
+
+        def retire(pool):
+            self.retired['connections'] += pool.num_connections
+            self.retired['requests'] += pool.num_requests
+            if dispose:
+                dispose(pool)
+        self.poolmanager.pools.dispose_func = retire
+
+    def stats(self):
+        stats = dict(self.retired)
+        pools = self.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                stats['connections'] += pool.num_connections
+                stats['requests'] += pool.num_requests
+        return stats
+
+
+class RemoteSession(requests.Session):
+    '''A keep-alive session to one remote (search engine, torrent host or
+    torrent client) with its own connection pool and default timeout'''
+
+    def __init__(self, pool_size=10, timeout=30, auth=None, headers=None):
+        super(RemoteSession, self).__init__()
+        self.timeout = timeout
+        # Keeping a single auth object lets digest auth reuse its nonce
+        self.auth = auth
+        if headers:
+            self.headers.update(headers)
+        self.adapter = CountingAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size)
+        self.mount('http://', self.adapter)
+        self.mount('https://', self.adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super(RemoteSession, self).request(method, url, **kwargs)
+
+    def stats(self):
+        '''Connections opened and requests made through this session'''
+        return self.adapter.stats()
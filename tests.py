@@ -1,9 +1,27 @@
 # coding: utf-8
 import unittest
+import json
 import os
 import shutil
+import socket
+import sqlite3
+import sys
+import threading
+import time
 import downloader as sad
-from subprocess import call
+from bs4 import FeatureNotFound
+from fake_index import FakeIndex
+from subprocess import PIPE, Popen, call
+
+
+# async/await only parses from Python 3.5 on
+requires_async = unittest.skipIf(
+    sys.version_info < (3, 5), 'the async engine needs Python 3.5')
+
+
+def async_engine():
+    from async_downloader import AsyncDownloader
+    return AsyncDownloader
 
 
 class SADTestCase(unittest.TestCase):
@@ -13,6 +31,12 @@ class SADTestCase(unittest.TestCase):
             os.rename('settings.json', 'settings.json.bkp')
         if 'watchlist.json' in test_dir:
             os.rename('watchlist.json', 'watchlist.json.bkp')
+        if 'watchlist.journal' in test_dir:
+            os.rename('watchlist.journal', 'watchlist.journal.bkp')
+        if 'watchlist.db' in test_dir:
+            os.rename('watchlist.db', 'watchlist.db.bkp')
+        if 'torrents.db' in test_dir:
+            os.rename('torrents.db', 'torrents.db.bkp')
         self.settings = sad.Settings()
         self.wl = sad.Watchlist(
             series_list=['Breaking.Bad', 'The.Big.Bang.Theory'])
@@ -32,8 +56,28 @@ class SADTestCase(unittest.TestCase):
         os.remove('watchlist.json')
         if 'watchlist.json.bkp' in test_dir:
             os.rename('watchlist.json.bkp', 'watchlist.json')
+        if os.path.exists('watchlist.journal'):
+            os.remove('watchlist.journal')
+        if 'watchlist.journal.bkp' in test_dir:
+            os.rename('watchlist.journal.bkp', 'watchlist.journal')
+        if os.path.exists('watchlist.db'):
+            os.remove('watchlist.db')
+        if 'watchlist.db.bkp' in test_dir:
+            os.rename('watchlist.db.bkp', 'watchlist.db')
         if 'log.txt' in test_dir:
             os.remove('log.txt')
+        if 'search_cache.json' in test_dir:
+            os.remove('search_cache.json')
+        if 'mirrors.json' in test_dir:
+            os.remove('mirrors.json')
+        if 'run_report.json' in test_dir:
+            os.remove('run_report.json')
+        if 'push_queue.json' in test_dir:
+            os.remove('push_queue.json')
+        if os.path.exists('torrents.db'):
+            os.remove('torrents.db')
+        if 'torrents.db.bkp' in test_dir:
+            os.rename('torrents.db.bkp', 'torrents.db')
         downloaded_list = [f for f in test_dir if '.torrent' in f]
         for f in downloaded_list:
             os.remove(f)
@@ -66,6 +110,41 @@ class TestWatchlist(SADTestCase):
         ep = self.wl.watchlist['Breaking.Bad']['latest-downloaded-episode']
         self.assertEqual('S01E01', ep)
 
+    def test_seeding_writes_watchlist_once(self):
+        writes = []
+        atomic_write = sad.atomic_write
+
+        def counting_write(filename, content):
+            writes.append(filename)
+            atomic_write(filename, content)
+        sad.atomic_write = counting_write
+        try:
+            sad.Watchlist(series_list=['Serie {0}'.format(n)
+                                       for n in range(50)])
+        finally:
+            sad.atomic_write = atomic_write
+        self.assertEqual(['watchlist.json'], writes)
+        self.assertEqual(52, len(self.wl.load_watchlist()))
+
+    def test_journal_is_replayed_and_compacted(self):
+        self.wl.update_watchlist('Breaking.Bad', 'S01E01')
+        self.wl.update_watchlist('Breaking.Bad', 'S01E02')
+        with open('watchlist.journal', 'a') as journal:
+            journal.write('{"name": "The.Big.Bang')
+        self.wl = sad.Watchlist()
+        ep = self.wl.watchlist['Breaking.Bad']['latest-downloaded-episode']
+        self.assertEqual('S01E02', ep)
+        self.assertNotIn('watchlist.journal', os.listdir(os.getcwd()))
+
+    def test_updates_without_journal_wait_for_flush(self):
+        self.wl = sad.Watchlist(journal=False)
+        self.wl.update_watchlist('Breaking.Bad', 'S01E01')
+        stored = self.wl.load_watchlist()['Breaking.Bad']
+        self.assertEqual('S01E00', stored['latest-downloaded-episode'])
+        self.wl.flush()
+        stored = self.wl.load_watchlist()['Breaking.Bad']
+        self.assertEqual('S01E01', stored['latest-downloaded-episode'])
+
     def test_append_new_series_list(self):
         '''User should be able to append new series using the cli'''
         call(['python', 'downloader.py', '-sl', 'The 100,True Detective'])
@@ -95,6 +174,47 @@ class TestWatchlist(SADTestCase):
         self.assertNotIn('True Detective', new_watchlist)
 
 
+class TestSQLiteWatchlist(SADTestCase):
+    def setUp(self):
+        super(TestSQLiteWatchlist, self).setUp()
+        self.wl.update_watchlist('Breaking.Bad', 'S02E03')
+        self.wl.watchlist['The.Big.Bang.Theory']['download'] = False
+        self.wl.flush()
+        self.db = sad.SQLiteWatchlist()
+        self.db.import_json('watchlist.json')
+
+    def tearDown(self):
+        self.db.close()
+        super(TestSQLiteWatchlist, self).tearDown()
+
+    def test_import_export_round_trip(self):
+        self.db.export_json('exported.json')
+        with open('exported.json') as exported:
+            self.assertEqual(self.wl.load_watchlist(), json.load(exported))
+        os.remove('exported.json')
+
+    def test_only_downloadable_series_are_loaded(self):
+        download_list = self.db.load_downloadable_watchlist()
+        self.assertEqual(['Breaking.Bad'], [s['name'] for s in download_list])
+        self.assertEqual('S02E04', download_list[0]['next_episode'])
+
+    def test_update_watchlist_is_stored(self):
+        self.db.update_watchlist('Breaking.Bad', 'S02E04')
+        self.db.close()
+        self.db = sad.SQLiteWatchlist()
+        ep = self.db.watchlist['Breaking.Bad']['latest-downloaded-episode']
+        self.assertEqual('S02E04', ep)
+
+    def test_settings_select_sqlite_store(self):
+        sad.Settings(watchlist_store='sqlite')
+        call(['python', 'downloader.py', '-sl', 'The 100'])
+        downloader = sad.Downloader()
+        self.assertIsInstance(downloader.series, sad.SQLiteWatchlist)
+        self.assertEqual(['Breaking.Bad', 'The.100'],
+                         [s['name'] for s in downloader.download_list])
+        downloader.series.close()
+
+
 class TestSettings(SADTestCase):
     def test_update_settings_with_download_folder(self):
         '''The download folder should be updatable via cli'''
@@ -108,6 +228,27 @@ class TestSettings(SADTestCase):
         call(['python', 'downloader.py', '-a', 'show_magnets'])
         self.assertEqual('show_magnets', sad.Settings().action)
 
+    def test_unchanged_settings_are_not_rewritten(self):
+        settings = sad.Settings(action='show_magnets')
+        self.assertEqual('show_magnets', settings.action)
+        inode = os.stat('settings.json').st_ino
+        sad.Settings(action='show_magnets')
+        self.assertEqual(inode, os.stat('settings.json').st_ino)
+
+    def test_config_commands_stay_offline(self):
+        '''Commands not going online must not pay for requests, bs4 and
+        sqlite3'''
+        for command in [[], ['-a', 'show_magnets'], ['-sl', 'The 100']]:
+            imports = Popen(
+                [sys.executable, '-X', 'importtime', 'downloader.py'] +
+                command,
+                stdout=PIPE, stderr=PIPE,
+                universal_newlines=True).communicate()[1]
+            modules = [line.split('|')[-1].strip()
+                       for line in imports.splitlines()]
+            for module in ['requests', 'bs4', 'remote', 'sqlite3']:
+                self.assertNotIn(module, modules, command)
+
 
 class TestDownloader(SADTestCase):
     def test_search_for(self):
@@ -122,11 +263,15 @@ class TestDownloader(SADTestCase):
         self.downloader.download_list[0]['quality'] = '4K'
         s = self.downloader.download_list[0]['name']
         del self.downloader.download_list[1]
-        self.downloader.run()
+        # An unreachable search engine is a failed search, not a miss
+        with FakeIndex() as index:
+            self.downloader.search_engine = index.search_engine
+            self.downloader.run()
         le = self.downloader.series.watchlist[s]['latest-downloaded-episode']
         self.assertIn('log.txt', os.listdir(os.getcwd()))
         self.assertIn('not found', open('log.txt').readline())
-        self.assertEqual(1, len(open('log.txt').readlines()))
+        not_found = [line for line in open('log.txt') if 'not found' in line]
+        self.assertEqual(1, len(not_found))
         self.assertEqual('S01E00', le)
 
     def test_run_download_torrent_files(self):
@@ -174,5 +319,875 @@ class TestDownloader(SADTestCase):
         self.assertIn(name.replace('.', '+').lower(), magnet_list)
 
 
+class TestParsers(SADTestCase):
+    def parse_fixture(self, parser, query):
+        name, episode = query.rsplit('.', 1)
+        with open(os.path.join('fixtures', query + '.html'), 'rb') as page:
+            soup = sad.make_soup(page.read(), parser)
+        return self.downloader.fetch_download_table(
+            soup, name, episode, limit=1000)
+
+    def test_parsers_return_the_same_options(self):
+        reference = self.parse_fixture('html.parser', 'Breaking.Bad.S03')
+        self.assertEqual(30, len(reference))
+        for parser in sad.PARSERS:
+            try:
+                options = self.parse_fixture(parser, 'Breaking.Bad.S03')
+            except FeatureNotFound:
+                continue
+            self.assertEqual(reference, options, parser)
+
+    def test_fetch_download_table_options(self):
+        options = self.parse_fixture('strainer', 'Firefly.S01E01')
+        self.assertEqual(['1080p', '720p', 'SD', '1080p'],
+                         [option['quality'] for option in options])
+        self.assertEqual('Firefly.S01E01', options[0]['name'])
+        self.assertEqual('300', options[2]['seeds'])
+
+
+class TestRanking(SADTestCase):
+    def options(self):
+        with open(os.path.join('fixtures', 'Firefly.S01E01.html'), 'rb') as page:
+            soup = sad.make_soup(page.read())
+        return self.downloader.fetch_download_table(soup, 'Firefly', 'S01E01')
+
+    def pick(self, preferences):
+        options = self.options()
+        download = self.downloader.select_download(options, preferences)
+        return download and [option['quality'] for option in options if
+                             option['magnet_link'] == download['magnet_link']][0]
+
+    def test_quality_fallback_order(self):
+        self.assertEqual('1080p', self.pick(sad.Preferences('1080p,720p,SD')))
+        self.assertEqual('720p', self.pick(sad.Preferences('4K,720p,SD')))
+        self.assertEqual('SD', self.pick('SD'))
+        self.assertIsNone(self.pick('4K'))
+
+    def test_seeds_and_size_bounds(self):
+        self.assertEqual('SD', self.pick(
+            sad.Preferences('720p,SD', min_seeds=200)))
+        self.assertEqual('720p', self.pick(
+            sad.Preferences('1080p,720p', max_size=1000)))
+        self.assertIsNone(self.pick(
+            sad.Preferences('1080p,720p,SD', min_size=2000)))
+
+    def test_sizes_are_read_in_megabytes(self):
+        self.assertEqual(['1400.00', '700.00', '250.00', '1402.88'],
+                         [option['size'] for option in self.options()])
+
+        def magnet(preferences):
+            download = self.downloader.select_download(
+                self.options(), preferences)
+            return download and download['magnet_link'].split('+')[-1]
+        # 1.37 GB over 30 seeds is slower than 1400 MB over 40
+        self.assertEqual('x264', magnet(sad.Preferences('1080p')))
+        self.assertEqual('x265', magnet(sad.Preferences('1080p', min_size=1401)))
+        self.assertIsNone(magnet(sad.Preferences('1080p', max_size=1000)))
+
+    def test_fastest_release_of_a_quality(self):
+        options = [dict(option, seeds=seeds) for option, seeds in zip(
+            self.options()[2:3] * 3,
+            ['2', '90', '0'])]
+        options[1]['magnet_link'] += '&fast'
+        download = self.downloader.select_download(options, 'SD')
+        self.assertTrue(download['magnet_link'].endswith('&fast'))
+
+    def test_watchlist_preferences(self):
+        self.wl.watchlist['Breaking.Bad'].update({
+            'quality': '1080p,720p', 'min-seeds': 100})
+        self.wl.save_watchlist()
+        serie = [serie for serie in sad.Watchlist().load_downloadable_watchlist()
+                 if serie['name'] == 'Breaking.Bad'][0]
+        preferences = self.downloader.preferences(serie)
+        self.assertEqual(['1080p', '720p'], preferences.qualities)
+        self.assertEqual(100, preferences.min_seeds)
+        self.assertEqual(0, preferences.max_size)
+
+
+class OfflineTestCase(SADTestCase):
+    '''Runs the downloader against a local fake index'''
+    @classmethod
+    def setUpClass(cls):
+        cls.index = FakeIndex().start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.index.stop()
+
+    def offline_downloader(self, engine=sad.Downloader, **kwargs):
+        remote_settings = {'download_url': self.index.download_url,
+                           'username': self.index.username,
+                           'password': self.index.password}
+        kwargs.setdefault('search_rate', '0')
+        kwargs.setdefault('search_engine', self.index.search_engine)
+        sad.Settings(remote_settings=remote_settings, **kwargs)
+        return engine()
+
+
+class TestConcurrentGather(OfflineTestCase):
+    def test_gather_keeps_watchlist_order(self):
+        '''Concurrent gather must return results in download_list order'''
+        os.remove('watchlist.json')
+        names = ['Serie.{0}'.format(n) for n in range(12)]
+        self.wl = sad.Watchlist(series_list=names)
+        self.downloader = self.offline_downloader(workers='4')
+        expected = [s['name'] + '.S01E01'
+                    for s in self.downloader.download_list]
+        found = self.downloader.gather_torrent_list()
+        self.assertEqual(expected, [t['name'] for t in found])
+
+    def test_concurrent_updates_reach_watchlist_file(self):
+        os.remove('watchlist.json')
+        names = ['Serie.{0}'.format(n) for n in range(12)]
+        self.wl = sad.Watchlist(series_list=names)
+        self.downloader = self.offline_downloader(workers='4')
+        self.downloader.gather_torrent_list()
+        watchlist = self.wl.load_watchlist()
+        for name in names:
+            self.assertEqual(
+                'S01E01', watchlist[name]['latest-downloaded-episode'])
+
+
+@requires_async
+class TestAsyncDownloader(OfflineTestCase):
+    def test_async_show_magnets(self):
+        self.downloader = self.offline_downloader(
+            engine=async_engine(), action='show_magnets')
+        magnets = self.downloader.run()
+        self.assertEqual(2, magnets.count('magnet'))
+        self.assertIn('breaking+bad+s01e01', magnets)
+        watchlist = self.wl.load_watchlist()
+        self.assertEqual(
+            'S01E01', watchlist['Breaking.Bad']['latest-downloaded-episode'])
+
+    def test_async_download_torrent_files(self):
+        self.downloader = self.offline_downloader(
+            engine=async_engine(), download_folder='Downloaded_Test')
+        self.downloader.run()
+        self.assertEqual(2, len(os.listdir('Downloaded_Test')))
+        self.assertIn('Breaking.Bad.S01E01.torrent',
+                      os.listdir('Downloaded_Test'))
+        shutil.rmtree('Downloaded_Test')
+
+    def test_every_mirror_host_is_limited(self):
+        sad.Watchlist(series_list=['Serie.{0}'.format(n) for n in range(6)])
+        mirror = FakeIndex(delay=0.05).start()
+        try:
+            self.downloader = self.offline_downloader(
+                engine=async_engine(), action='show_magnets',
+                host_connections='1', workers='4',
+                search_engine=[self.index.search_engine,
+                               mirror.search_engine])
+            session = self.downloader.sessions['search_engine']
+            get = session.get
+            lock = threading.Lock()
+            running, peak = {}, {}
+
+            def counting_get(url, **kwargs):
+                host = url.split('/')[2]
+                with lock:
+                    running[host] = running.get(host, 0) + 1
+                    peak[host] = max(peak.get(host, 0), running[host])
+                try:
+                    return get(url, **kwargs)
+                finally:
+                    with lock:
+                        running[host] -= 1
+            session.get = counting_get
+            self.assertEqual(8, self.downloader.run().count('magnet'))
+        finally:
+            mirror.stop()
+        self.assertEqual([1, 1], list(peak.values()))
+
+
+class TestRetries(OfflineTestCase):
+    def setUp(self):
+        super(TestRetries, self).setUp()
+        self.downloader = self.offline_downloader()
+        self.delays = []
+        self.downloader.scheduler.sleep = self.delays.append
+        self.downloader.download_list = self.downloader.download_list[:1]
+
+    def test_server_errors_are_retried(self):
+        self.index.fail(503, count=2)
+        found = self.downloader.gather_torrent_list()
+        self.assertEqual(1, len(found))
+        self.assertEqual(2, len(self.delays))
+        self.assertTrue(all(0 <= delay <= 2 for delay in self.delays))
+
+    def test_retry_after_is_honored(self):
+        self.index.fail(429, retry_after=7)
+        self.downloader.gather_torrent_list()
+        self.assertEqual([7], self.delays)
+
+    def test_failed_search_is_logged(self):
+        self.index.fail(500, count=3)
+        self.assertEqual([], self.downloader.gather_torrent_list())
+        self.assertIn('search failed (500', open('log.txt').read())
+        ep = self.wl.load_watchlist()['Breaking.Bad']
+        self.assertEqual('S01E00', ep['latest-downloaded-episode'])
+
+    def test_missing_episode_is_not_retried(self):
+        self.wl.update_watchlist('Breaking.Bad', 'S03E10')
+        self.downloader = self.offline_downloader()
+        self.downloader.download_list = self.downloader.download_list[:1]
+        requests = self.index.requests
+        self.assertEqual([], self.downloader.gather_torrent_list())
+        # the episode and the next season, once each
+        self.assertEqual(requests + 2, self.index.requests)
+
+    def test_rate_limiter(self):
+        limiter = sad.RateLimiter(rate=20, burst=2)
+        start = time.time()
+        for _ in range(4):
+            limiter.acquire('index')
+        limiter.acquire('other.index')
+        self.assertGreaterEqual(time.time() - start, 0.09)
+        self.assertLess(time.time() - start, 0.5)
+
+
+class TestIdleSeries(OfflineTestCase):
+    def setUp(self):
+        super(TestIdleSeries, self).setUp()
+        self.wl.update_watchlist('Breaking.Bad', 'S03E10')
+        self.wl.flush()
+
+    def run_downloader(self, **kwargs):
+        self.downloader = self.offline_downloader(**kwargs)
+        requests = self.index.requests
+        found = self.downloader.gather_torrent_list()
+        self.downloader.finish_gather()
+        return found, self.index.requests - requests
+
+    def test_misses_are_recorded(self):
+        self.run_downloader()
+        watchlist = self.wl.load_watchlist()
+        self.assertEqual(1, watchlist['Breaking.Bad']['misses'])
+        self.assertGreater(watchlist['Breaking.Bad']['last-checked'], 0)
+        self.assertEqual(0, watchlist['The.Big.Bang.Theory']['misses'])
+
+    def test_idle_series_are_skipped(self):
+        self.run_downloader()
+        found, requests = self.run_downloader()
+        self.assertEqual(1, requests)
+        self.assertEqual(1, self.downloader.skipped)
+        self.assertIn('skipped 1 of 2 series', open('log.txt').read())
+
+    def test_check_all(self):
+        self.run_downloader()
+        self.downloader = self.offline_downloader()
+        self.downloader.check_all = True
+        self.downloader.gather_torrent_list()
+        self.assertEqual(0, self.downloader.skipped)
+
+    def test_backoff_grows_with_misses(self):
+        now = time.time()
+        serie = {'name': 'Breaking.Bad', 'next_episode': 'S03E11',
+                 'next_season': 'S04E01', 'misses': 3,
+                 'last_checked': now - 3 * 3600}
+        self.assertFalse(self.downloader.is_due(serie, now))
+        serie['last_checked'] = now - 4 * 3600
+        self.assertTrue(self.downloader.is_due(serie, now))
+        serie['misses'] = 30
+        self.assertFalse(self.downloader.is_due(serie, now))
+        serie['last_checked'] = now - 86400
+        self.assertTrue(self.downloader.is_due(serie, now))
+
+    def test_air_schedule(self):
+        self.run_downloader()
+        with open('schedule_test.json', 'w') as schedule:
+            json.dump({'Breaking.Bad': {'S04E01': '2000-01-01'},
+                       'The.Big.Bang.Theory': {'S01E02': '2999-01-01'}},
+                      schedule)
+        self.run_downloader(schedule_file='schedule_test.json')
+        os.remove('schedule_test.json')
+        # Breaking.Bad aired despite the misses, The.Big.Bang.Theory didn't
+        watchlist = self.wl.load_watchlist()
+        self.assertEqual(2, watchlist['Breaking.Bad']['misses'])
+        self.assertEqual(1, self.downloader.skipped)
+
+
+class TestMirrors(OfflineTestCase):
+    def setUp(self):
+        super(TestMirrors, self).setUp()
+        self.slow = FakeIndex(delay=0.5).start()
+        self.broken = FakeIndex().start()
+        self.broken.fail(500, count=100)
+
+    def tearDown(self):
+        self.slow.stop()
+        self.broken.stop()
+        super(TestMirrors, self).tearDown()
+
+    def mirror_downloader(self, *mirrors):
+        self.downloader = self.offline_downloader()
+        self.downloader.mirrors = sad.Mirrors(
+            [mirror.search_engine for mirror in mirrors])
+        self.downloader.search_engine = self.downloader.mirrors.engines[0]
+        self.downloader.scheduler.sleep = lambda seconds: None
+        return self.downloader
+
+    def test_fastest_mirror_wins(self):
+        downloader = self.mirror_downloader(self.slow, self.index)
+        start = time.time()
+        found = downloader.search_for('Firefly', 'S01E01')
+        self.assertLess(time.time() - start, 0.4)
+        self.assertEqual(3, len(found))
+
+    def test_only_the_winner_is_cached(self):
+        downloader = self.mirror_downloader(self.slow, self.index)
+        downloader.search_for('Firefly', 'S01E01')
+        time.sleep(0.6)
+        self.assertEqual(1, downloader.cache.stats['misses'])
+        entry = list(downloader.cache.entries.values())[0]
+        self.assertEqual(2, downloader.mirrors.stats[
+            self.slow.search_engine]['requests'] +
+            downloader.mirrors.stats[self.index.search_engine]['requests'])
+        self.assertEqual(3, len(entry['rows']))
+
+    def test_not_found_is_an_answer(self):
+        downloader = self.mirror_downloader(self.slow, self.index)
+        downloader.hedge = 2
+        self.slow.fail(404)
+        self.index.fail(404)
+        found = downloader.get_torrent('Firefly', 'S01E05', '720p')
+        self.assertEqual('S02E01', found['episode'])
+        for stats in downloader.mirrors.stats.values():
+            self.assertEqual(0, stats['errors'])
+
+    def test_broken_mirror_loses(self):
+        downloader = self.mirror_downloader(self.broken, self.index)
+        self.assertEqual(3, len(downloader.search_for('Firefly', 'S01E01')))
+
+    def test_mirrors_are_ranked(self):
+        downloader = self.mirror_downloader(self.slow, self.broken, self.index)
+        downloader.hedge = 3
+        for episode in ['S01E01', 'S01E02', 'S01E03']:
+            downloader.search_for('Firefly', episode)
+        time.sleep(0.6)
+        self.assertEqual(
+            [self.index.search_engine, self.slow.search_engine,
+             self.broken.search_engine], downloader.mirrors.ranked())
+        downloader.mirrors.save()
+        mirrors = sad.Mirrors(downloader.mirrors.engines)
+        self.assertEqual(downloader.mirrors.ranked(), mirrors.ranked())
+
+    def test_settings_accept_a_mirror_list(self):
+        self.downloader = self.offline_downloader(search_engine=[
+            self.index.search_engine, self.slow.search_engine])
+        self.assertEqual(2, len(self.downloader.mirrors))
+        self.assertEqual(self.index.search_engine,
+                         self.downloader.search_engine)
+
+
+class TestDaemon(OfflineTestCase):
+    def setUp(self):
+        super(TestDaemon, self).setUp()
+        self.offline_downloader(action='show_magnets')
+        self.daemon = sad.Daemon()
+
+    def bump(self, filename):
+        stat = os.stat(filename)
+        os.utime(filename, (stat.st_atime, stat.st_mtime + 10))
+
+    def test_downloader_is_kept_warm(self):
+        self.daemon.run_once()
+        downloader = self.daemon.downloader
+        self.daemon.run_once()
+        self.assertIs(downloader, self.daemon.downloader)
+        self.assertEqual(2, self.daemon.runs)
+        ep = self.wl.load_watchlist()['Breaking.Bad']
+        self.assertEqual('S01E02', ep['latest-downloaded-episode'])
+
+    def test_changed_settings_are_reloaded(self):
+        self.daemon.run_once()
+        downloader = self.daemon.downloader
+        self.bump('settings.json')
+        self.daemon.run_once()
+        self.assertIsNot(downloader, self.daemon.downloader)
+
+    def test_changed_watchlist_is_reloaded(self):
+        self.daemon.run_once()
+        downloader = self.daemon.downloader
+        sad.Watchlist(series_list=['The.100'])
+        self.bump('watchlist.json')
+        self.daemon.run_once()
+        self.assertIs(downloader, self.daemon.downloader)
+        self.assertIn('The.100', downloader.series.watchlist)
+
+    def test_reloaded_watchlist_db_is_closed(self):
+        sad.Settings(watchlist_store='sqlite')
+        self.daemon.run_once()
+        series = self.daemon.downloader.series
+        self.bump('watchlist.db')
+        self.daemon.run_once()
+        self.assertIsNot(series, self.daemon.downloader.series)
+        self.assertRaises(sqlite3.ProgrammingError,
+                          series.connection.execute, 'SELECT 1')
+        self.daemon.close_downloader()
+
+    def test_silent_client_does_not_block_commands(self):
+        self.daemon.command_timeout = 0.2
+        sad.Settings(daemon_port='18632', daemon_interval='3600')
+        thread = threading.Thread(target=self.daemon.serve)
+        thread.start()
+        silent = None
+        try:
+            for _ in range(50):
+                if self.daemon.runs:
+                    break
+                time.sleep(0.1)
+            silent = socket.create_connection(('127.0.0.1', 18632), 10)
+            self.assertEqual('ok', sad.send_command('18632', 'run'))
+        finally:
+            if silent is not None:
+                silent.close()
+            sad.send_command('18632', 'stop')
+            thread.join(10)
+        self.assertFalse(thread.is_alive())
+
+    def test_control_port_triggers_a_run(self):
+        sad.Settings(daemon_port='18631', daemon_interval='3600')
+        thread = threading.Thread(target=self.daemon.serve)
+        thread.start()
+        try:
+            for _ in range(50):
+                if self.daemon.runs:
+                    break
+                time.sleep(0.1)
+            self.assertEqual('ok', sad.send_command('18631', 'run'))
+            for _ in range(50):
+                if self.daemon.runs > 1:
+                    break
+                time.sleep(0.1)
+            self.assertEqual(2, self.daemon.runs)
+        finally:
+            sad.send_command('18631', 'stop')
+            thread.join(10)
+        self.assertFalse(thread.is_alive())
+
+
+class TestCatchUp(OfflineTestCase):
+    def test_catch_up_on_the_season_with_one_search(self):
+        self.wl.update_watchlist('Breaking.Bad', 'S01E07')
+        self.downloader = self.offline_downloader(catch_up=True)
+        self.downloader.download_list = [
+            s for s in self.downloader.download_list
+            if s['name'] == 'Breaking.Bad']
+        requests = self.index.requests
+        found = self.downloader.gather_torrent_list()
+        self.assertEqual(['S01E08', 'S01E09', 'S01E10'],
+                         [torrent['episode'] for torrent in found])
+        self.assertEqual('Breaking.Bad.S01E08', found[0]['name'])
+        self.assertEqual(requests + 1, self.index.requests)
+        ep = self.wl.load_watchlist()['Breaking.Bad']
+        self.assertEqual('S01E10', ep['latest-downloaded-episode'])
+
+    def test_catch_up_moves_to_the_next_season(self):
+        self.wl.update_watchlist('Breaking.Bad', 'S01E10')
+        self.downloader = self.offline_downloader(catch_up=True)
+        found = self.downloader.gather_torrent_list()
+        self.assertEqual(20, len(found))
+        ep = self.wl.load_watchlist()['Breaking.Bad']
+        self.assertEqual('S02E10', ep['latest-downloaded-episode'])
+
+    def test_watchlist_stops_at_the_first_missing_episode(self):
+        self.downloader = self.offline_downloader()
+        options = [o for o in self.downloader.search_for(
+            'Breaking.Bad', 'S01', limit=100) if o['episode'] != 'S01E03']
+        self.downloader.search_for = lambda *args, **kwargs: options
+        self.downloader.download_list = self.downloader.download_list[:1]
+        self.downloader.catch_up = True
+        found = self.downloader.gather_torrent_list()
+        self.assertEqual(9, len(found))
+        ep = self.wl.load_watchlist()['Breaking.Bad']
+        self.assertEqual('S01E02', ep['latest-downloaded-episode'])
+
+
+class TestPipelinedRun(OfflineTestCase):
+    def test_torrents_reach_the_action_as_found(self):
+        self.downloader = self.offline_downloader(
+            action='download_from_magnets', push_batch='1')
+        events = []
+        gather_serie = self.downloader.gather_serie
+        push_magnet_link = self.downloader.push_magnet_link
+
+        def searching(serie):
+            events.append('search ' + serie['name'])
+            return gather_serie(serie)
+
+        def pushing(magnet_link):
+            events.append('push')
+            push_magnet_link(magnet_link)
+        self.downloader.gather_serie = searching
+        self.downloader.push_magnet_link = pushing
+        self.downloader.run()
+        self.assertEqual(['search Breaking.Bad', 'push',
+                          'search The.Big.Bang.Theory', 'push'], events)
+
+    def test_torrent_files_are_streamed_to_disk(self):
+        self.downloader = self.offline_downloader(
+            download_folder='Downloaded_Test', workers='2')
+        self.downloader.run()
+        files = sorted(os.listdir('Downloaded_Test'))
+        self.assertEqual(['Breaking.Bad.S01E01.torrent',
+                          'The.Big.Bang.Theory.S01E01.torrent'], files)
+        with open(os.path.join('Downloaded_Test', files[0]), 'rb') as file:
+            self.assertTrue(file.read().startswith(b'd4:info'))
+        shutil.rmtree('Downloaded_Test')
+
+
+class TestRemoteSessions(OfflineTestCase):
+    def test_search_reuses_connection(self):
+        os.remove('watchlist.json')
+        names = ['Serie.{0}'.format(n) for n in range(12)]
+        self.wl = sad.Watchlist(series_list=names)
+        self.downloader = self.offline_downloader()
+        self.downloader.gather_torrent_list()
+        stats = self.downloader.connection_stats()['search_engine']
+        self.assertEqual(12, stats['requests'])
+        self.assertEqual(1, stats['connections'])
+
+    def test_push_reuses_digest_nonce(self):
+        '''Only the first magnet push should be challenged by the client'''
+        self.downloader = self.offline_downloader()
+        challenges = self.index.challenges
+        magnets = ['magnet:?xt=urn:btih:{0}'.format(n) for n in range(3)]
+        for magnet in magnets:
+            self.downloader.push_magnet_link(magnet)
+        stats = self.downloader.connection_stats()['torrent_client']
+        self.assertEqual(1, self.index.challenges - challenges)
+        self.assertEqual(4, stats['requests'])
+        self.assertEqual(1, stats['connections'])
+        for magnet in magnets:
+            self.assertIn(magnet, self.index.pushed)
+
+
+class TestSearchCache(OfflineTestCase):
+    def test_fresh_results_skip_the_network(self):
+        self.downloader = self.offline_downloader()
+        found = self.downloader.search_for('Firefly', 'S01E01')
+        self.downloader.cache.save()
+        requests = self.index.requests
+        self.downloader = sad.Downloader()
+        self.assertEqual(found, self.downloader.search_for('Firefly', 'S01E01'))
+        self.assertEqual(requests, self.index.requests)
+        self.assertEqual(1, self.downloader.cache.stats['hits'])
+
+    def test_expired_results_are_revalidated(self):
+        self.downloader = self.offline_downloader(
+            search_cache={'ttl': '0', 'size': '10'})
+        found = self.downloader.search_for('Firefly', 'S01E01')
+        self.assertEqual(found, self.downloader.search_for('Firefly', 'S01E01'))
+        self.assertEqual(1, self.downloader.cache.stats['revalidated'])
+        self.assertEqual(1, self.downloader.cache.stats['misses'])
+
+    def test_no_cache(self):
+        self.downloader = self.offline_downloader()
+        self.downloader.search_for('Firefly', 'S01E01')
+        self.downloader.cache.save()
+        self.downloader = sad.Downloader(use_cache=False)
+        requests = self.index.requests
+        self.downloader.search_for('Firefly', 'S01E01')
+        self.assertEqual(requests + 1, self.index.requests)
+        self.assertEqual(0, self.downloader.cache.stats['hits'])
+
+    def test_least_recently_used_entries_are_evicted(self):
+        self.downloader = self.offline_downloader(
+            search_cache={'ttl': '3600', 'size': '2'})
+        for episode in ['S01E01', 'S01E02', 'S01E01', 'S01E03']:
+            self.downloader.search_for('Firefly', episode)
+        urls = list(self.downloader.cache.entries)
+        self.assertEqual([self.downloader.search_url('Firefly', 'S01E01'),
+                          self.downloader.search_url('Firefly', 'S01E03')],
+                         urls)
+
+    def test_run_logs_cache_stats(self):
+        self.downloader = self.offline_downloader(action='show_magnets')
+        self.downloader.run()
+        self.assertIn('search cache: 0 hits, 0 revalidated, 2 misses',
+                      open('log.txt').read())
+
+
+class TestRunReport(OfflineTestCase):
+    def test_run_writes_report(self):
+        self.downloader = self.offline_downloader(
+            download_folder='Downloaded_Test')
+        self.downloader.run()
+        shutil.rmtree('Downloaded_Test')
+        with open('run_report.json') as report_file:
+            report = json.load(report_file)
+        host = self.index.url[len('http://'):]
+        search = report['phases']['search']
+        self.assertEqual(2, search['count'])
+        self.assertEqual(2, search['hosts'][host]['count'])
+        self.assertEqual(2, sum(search['histogram']))
+        self.assertEqual(2, report['phases']['parse']['count'])
+        self.assertEqual(2, report['phases']['torrent']['count'])
+        self.assertTrue(report['phases']['torrent']['bytes'] > 0)
+        self.assertEqual(2, len(report['slowest_series']))
+        self.assertEqual(2, report['series'])
+
+    @requires_async
+    def test_async_run_reports_series(self):
+        self.downloader = self.offline_downloader(
+            engine=async_engine(), action='show_magnets')
+        self.downloader.run()
+        with open('run_report.json') as report_file:
+            report = json.load(report_file)
+        self.assertEqual(2, report['series'])
+        self.assertEqual(2, len(report['slowest_series']))
+        self.assertEqual(2, report['phases']['search']['count'])
+
+    def test_failed_requests_are_counted(self):
+        self.downloader = self.offline_downloader(retries='0')
+        self.index.fail(500, count=2)
+        self.downloader.gather_torrent_list()
+        report = self.downloader.run_report()
+        self.assertEqual(2, report['phases']['search']['errors'])
+
+    def test_report_can_be_disabled(self):
+        self.downloader = self.offline_downloader(report_file='')
+        self.downloader.run()
+        self.assertNotIn('run_report.json', os.listdir(os.getcwd()))
+
+
+class TestBatchPush(OfflineTestCase):
+    def setUp(self):
+        super(TestBatchPush, self).setUp()
+        os.remove('watchlist.json')
+        names = ['Serie.{0}'.format(n) for n in range(5)]
+        self.wl = sad.Watchlist(series_list=names)
+
+    def magnets(self):
+        '''The magnets a run finds, without moving the watchlist'''
+        downloader = self.offline_downloader()
+        return [downloader.get_torrent(name, 'S01E01', 'SD')['magnet_link']
+                for name in sorted(self.wl.watchlist)]
+
+    def reload_download_list(self):
+        self.downloader.download_list = \
+            self.downloader.series.load_downloadable_watchlist()
+
+    def test_magnets_are_pushed_in_batches(self):
+        self.downloader = self.offline_downloader(
+            action='download_from_magnets', push_batch='2')
+        batches = self.index.batches
+        pushed = len(self.index.pushed)
+        self.downloader.run()
+        self.assertEqual(3, self.index.batches - batches)
+        self.assertEqual(5, len(self.index.pushed) - pushed)
+
+    def test_failing_client_keeps_the_magnets_for_the_next_run(self):
+        magnets = self.magnets()
+        self.downloader = self.offline_downloader(
+            action='download_from_magnets', push_batch='2')
+        pushes = []
+        push_magnet_link = self.downloader.push_magnet_link
+
+        def counting(magnet_link):
+            pushes.append(magnet_link)
+            push_magnet_link(magnet_link)
+        self.downloader.push_magnet_link = counting
+        iter_torrents = self.downloader.iter_torrents
+
+        def failing_once_searched(ordered=False):
+            torrents = list(iter_torrents(ordered))
+            self.index.fail(503)
+            return iter(torrents)
+        self.downloader.iter_torrents = failing_once_searched
+        pushed = len(self.index.pushed)
+        self.downloader.run()
+        self.assertEqual(1, len(pushes))
+        self.assertEqual(pushed, len(self.index.pushed))
+        self.assertNotIn('rejected', open('log.txt').read())
+        with open('push_queue.json') as queue:
+            self.assertEqual(sorted(magnets), sorted(json.load(queue)))
+        # The same instance, as the daemon keeps it between runs
+        del self.downloader.iter_torrents
+        self.reload_download_list()
+        self.downloader.run()
+        for magnet in magnets:
+            self.assertIn(magnet, self.index.pushed[pushed:])
+        self.assertEqual(10, len(self.index.pushed) - pushed)
+        self.assertEqual([], self.downloader.deferred_magnets)
+        self.assertNotIn('push_queue.json', os.listdir(os.getcwd()))
+        self.reload_download_list()
+        self.downloader.run()
+        self.assertEqual(15, len(self.index.pushed) - pushed)
+
+    def test_push_queue_has_each_magnet_once(self):
+        magnets = self.magnets()
+        self.downloader = self.offline_downloader(
+            action='download_from_magnets')
+        self.downloader.deferred_magnets = magnets + magnets[:2]
+        self.downloader.save_push_queue()
+        self.assertEqual(magnets, self.downloader.load_push_queue())
+
+    def test_rejected_magnet_is_isolated(self):
+        magnets = self.magnets()
+        self.index.reject(magnets[2])
+        self.downloader = self.offline_downloader(
+            action='download_from_magnets', push_batch='5')
+        pushed = len(self.index.pushed)
+        try:
+            self.downloader.run()
+        finally:
+            self.index.rejected.clear()
+        self.assertEqual(sorted(set(magnets) - {magnets[2]}),
+                         sorted(self.index.pushed[pushed:]))
+        self.assertIn('rejected by the torrent client', open('log.txt').read())
+        self.assertNotIn(magnets[2], self.downloader.torrents)
+
+    def test_pushed_magnets_are_not_pushed_again(self):
+        magnets = self.magnets()
+        self.downloader = self.offline_downloader(
+            action='download_from_magnets')
+        self.downloader.push_magnets(magnets[:3])
+        self.downloader.torrents.save()
+        self.downloader.close()
+        self.downloader = sad.Downloader()
+        for magnet in magnets:
+            self.downloader.queue_magnet(magnet)
+        self.assertEqual(magnets[3:], self.downloader.pending_magnets)
+
+
+class TestFailedTorrent(OfflineTestCase):
+    def setUp(self):
+        super(TestFailedTorrent, self).setUp()
+        os.remove('watchlist.json')
+        self.wl = sad.Watchlist(
+            series_list=['Serie.{0}'.format(n) for n in range(6)])
+
+    def run_with_a_missing_torrent(self, engine=sad.Downloader):
+        self.downloader = self.offline_downloader(
+            engine=engine, download_folder='Downloaded_Test', workers='4')
+        gather_serie = self.downloader.gather_serie
+
+        def missing_torrent(serie):
+            torrents = gather_serie(serie)
+            if serie['name'] == 'Serie.2':
+                for torrent in torrents:
+                    torrent['torrent_url'] = torrent['torrent_url'].replace(
+                        '/torrent/', '/missing/')
+            return torrents
+        self.downloader.gather_serie = missing_torrent
+        try:
+            self.downloader.run()
+            self.assertEqual(5, len(os.listdir('Downloaded_Test')))
+        finally:
+            shutil.rmtree('Downloaded_Test')
+        watchlist = self.wl.load_watchlist()
+        for name, serie in watchlist.items():
+            episode = 'S01E00' if name == 'Serie.2' else 'S01E01'
+            self.assertEqual(episode, serie['latest-downloaded-episode'])
+        self.assertIn('Serie.2.S01E01 download failed',
+                      open('log.txt').read())
+
+    def test_failed_torrent_is_left_for_the_next_run(self):
+        self.run_with_a_missing_torrent()
+
+    @requires_async
+    def test_async_failed_torrent_is_left_for_the_next_run(self):
+        self.run_with_a_missing_torrent(async_engine())
+
+
+class TestTorrentIndex(SADTestCase):
+    magnets = ['magnet:?xt=urn:btih:{0:040X}&dn=serie'.format(n)
+               for n in range(200)]
+
+    def test_lookup(self):
+        index = sad.TorrentIndex(capacity=100)
+        index.add(self.magnets[:100], 'Serie')
+        self.assertTrue(all(magnet in index for magnet in self.magnets[:100]))
+        self.assertFalse(any(magnet in index for magnet in self.magnets[100:]))
+        self.assertIn(self.magnets[0].replace('&dn=serie', '').lower(), index)
+        index.close()
+
+    def test_filter_is_rebuilt_when_not_saved(self):
+        index = sad.TorrentIndex(capacity=100)
+        index.add(self.magnets[:10])
+        index.save()
+        index.add(self.magnets[10:20])
+        index.close()
+        index = sad.TorrentIndex(capacity=100)
+        self.assertTrue(all(magnet in index for magnet in self.magnets[:20]))
+        index.close()
+
+
+class TestDuplicateTorrents(OfflineTestCase):
+    def test_torrent_is_not_downloaded_twice(self):
+        self.downloader = self.offline_downloader(
+            download_folder='Downloaded_Test')
+        self.downloader.run()
+        self.downloader.close()
+        shutil.rmtree('Downloaded_Test')
+        # A crash before the watchlist was saved finds the same episodes
+        self.wl.create_raw_watchlist()
+        self.downloader = sad.Downloader()
+        self.downloader.run()
+        self.assertFalse(os.listdir('Downloaded_Test'))
+        self.assertEqual(2, open('log.txt').read().count(
+            'already downloaded, skipped'))
+        self.assertEqual(
+            'S01E01', self.downloader.series.watchlist[
+                'Breaking.Bad']['latest-downloaded-episode'])
+        shutil.rmtree('Downloaded_Test')
+
+    def test_duplicate_rows_are_dropped(self):
+        self.downloader = self.offline_downloader()
+        with open(os.path.join('fixtures', 'Firefly.S01E01.html'), 'rb') as page:
+            soup = sad.make_soup(page.read())
+        rows = soup.findAll('table')[1].findAll('tr')
+        rows[1].insert_after(sad.make_soup(str(rows[1]), 'html.parser').tr)
+        options = self.downloader.fetch_download_table(
+            soup, 'Firefly', 'S01E01', limit=100)
+        links = [option['magnet_link'] for option in options]
+        self.assertEqual(len(set(links)), len(links))
+
+
+class FailingShard(sad.Downloader):
+    def run(self):
+        if self.shard[0] == 0:
+            raise RuntimeError('shard crashed')
+        return super(FailingShard, self).run()
+
+
+class TestShardedRun(OfflineTestCase):
+    def setUp(self):
+        super(TestShardedRun, self).setUp()
+        os.remove('watchlist.json')
+        self.names = ['Serie.{0}'.format(n) for n in range(8)]
+        self.wl = sad.Watchlist(series_list=self.names)
+
+    def episodes(self):
+        return dict((name, serie['latest-downloaded-episode']) for name, serie
+                    in sad.Watchlist().load_watchlist().items())
+
+    def test_shards_are_stable_and_cover_the_watchlist(self):
+        shards = [sad.shard_of(name, 3) for name in self.names]
+        self.assertEqual(shards, [sad.shard_of(name, 3) for name in self.names])
+        self.assertTrue(set(shards) <= {0, 1, 2})
+
+    def test_sharded_run_merges_the_watchlist(self):
+        self.downloader = self.offline_downloader(action='show_magnets')
+        magnets = self.downloader.run_shards(3)
+        self.assertEqual(8, len(magnets.split('\n')))
+        self.assertEqual(dict.fromkeys(self.names, 'S01E01'), self.episodes())
+        self.assertNotIn('watchlist.journal', os.listdir(os.getcwd()))
+        watchlist = sad.Watchlist().load_watchlist()
+        self.assertTrue(all(serie['last-checked'] for serie in watchlist.values()))
+        self.assertEqual(8, len(sad.SearchCache().entries))
+
+    def test_failed_shard_is_left_for_the_next_run(self):
+        self.downloader = self.offline_downloader(action='show_magnets')
+        self.downloader.run_shards(2, FailingShard)
+        failed = [name for name in self.names if sad.shard_of(name, 2) == 0]
+        expected = dict((name, 'S01E00' if name in failed else 'S01E01')
+                        for name in self.names)
+        self.assertEqual(expected, self.episodes())
+        self.assertIn('shard 1 of 2 failed', open('log.txt').read())
+
+
 if __name__ == '__main__':
     unittest.main()